@@ -1,73 +1,251 @@
-from statistics import mean
-from collections import Counter, defaultdict
 import numpy as np
-import re, itertools, math
+import re
 
 import logging
 logging.basicConfig(filename='example.log', filemode='w', level=logging.DEBUG, format='%(levelname)s:  %(message)s')
 
 '''-----------Base array creation and conversion----------------'''
-def tokenize(items):
-    split_items = [re.findall('[a-zA-Z]+|[0-9]+',item) for item in items]
-
-    # Pad with empty strings
-    max_tokens = max([len(tkns) for tkns in split_items])
-    for i,tkns in enumerate(split_items):
-        if len(tkns) < max_tokens:
-            split_items[i].extend(['']*(max_tokens-len(tkns)))
+BLANK = 0 # id of the empty token that pads rows
 
-    return np.array(split_items).astype('U256')
+class Vocabulary():
+    '''Interned token strings. Token ids index into self.strings and id BLANK is always ''.'''
+    def __init__(self, strings=()) -> None:
+        self.strings = ['']
+        self.ids = {'': BLANK}
+        for string in strings:
+            self.intern(string)
 
-def to_Tokens(a):
-    out = a.copy().astype('object')
-    for irow, icol in itertools.product(range(a.shape[0]),range(a.shape[1])):
-        out[irow][icol] = Token(irow, icol, a[irow][icol])
+    def __len__(self):
+        return len(self.strings)
 
-    out = set_token_tensions(out)
+    def __getitem__(self, token_id):
+        return self.strings[token_id]
 
-    return out
+    def intern(self, string):
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.ids[string]
 
-def to_array(tokens):
-    return np.ndarray([[tkn.val for tkn in row] for row in tokens]).astype('U256')
+    def decode(self, ids):
+        '''Object array of the strings of an array of token ids.'''
+        return np.array(self.strings, dtype=object)[ids]
 
+def tokenize(items):
+    '''Split every item into its runs of letters and of digits. All items go through one
+    regex pass (joined by a separator that is matched as its own token) and the tokens are
+    interned with np.unique. Returns (ids, lengths, vocab): the int32 matrix of token ids,
+    one row per item padded with BLANK, the number of tokens of each item and the Vocabulary.'''
+    tokens = np.array(re.findall('[a-zA-Z]+|[0-9]+|\x00', '\x00'.join(items)+'\x00'))
+    is_end = tokens == '\x00'
+    words = ~is_end
+    rows = (np.cumsum(is_end) - is_end)[words]
+    lengths = np.bincount(rows, minlength=len(items)).astype(np.int32)
+    cols = np.arange(len(rows)) - (np.cumsum(lengths) - lengths)[rows]
+
+    strings, inverse = np.unique(tokens[words], return_inverse=True)
+    ids = np.full((len(items), lengths.max(initial=0)), BLANK, dtype=np.int32)
+    ids[rows, cols] = inverse + 1 # np.unique sorts, so interning in that order gives these ids
+    return ids, lengths, Vocabulary(strings.tolist())
+
+def bench_tokenize(n=100000):
+    '''Bytes used by the token id matrix against the U256 string matrix it replaces.'''
+    items = [f'THselection_QCDHT{700+100*(i%7)}_htag0p{i%10}_{16+i%3}_part{i}.root' for i in range(n)]
+    ids, lengths, vocab = tokenize(items)
+    old_bytes = ids.size * np.dtype('U256').itemsize
+    logging.info(f'{n} items: {ids.nbytes+lengths.nbytes} bytes of token ids vs {old_bytes} bytes of U256, {len(vocab)} distinct tokens')
+    return ids.nbytes+lengths.nbytes, old_bytes
+
+def _per_row(x):
+    x = np.asarray(x)
+    return x[:, None] if x.ndim == 1 else x
+
+def alternate_runs(match):
+    '''Keep every other cell of each run of consecutive True cells in a row, starting from the left.'''
+    run_start = match & ~np.pad(match, ((0,0),(1,0)))[:, :-1]
+    pos = np.arange(match.shape[1]) - np.maximum.accumulate(np.where(run_start, np.arange(match.shape[1]), 0), axis=1)
+    return match & (pos % 2 == 0)
+
+def pair_mask(ids, a, b):
+    '''Mask of the cells (irow, icol) followed by the pair of token ids (a, b), at least
+    one column short of ids. a and b are scalars or one value per row. Overlapping matches
+    in a row (eg. a a a for (a, a)) are resolved from the left like successive merges would;
+    for a != b matches cannot overlap.'''
+    return alternate_runs((ids[:, :-1] == _per_row(a)) & (ids[:, 1:] == _per_row(b)))
+
+def compact_rows(ids, deleted):
+    '''Drop the deleted cells of every row, shift the rest left and pad with BLANK.'''
+    order = np.argsort(deleted, axis=1, kind='stable')
+    out = np.take_along_axis(ids, order, axis=1)
+    out[np.take_along_axis(deleted, order, axis=1)] = BLANK
+    return out
 
 '''-----------Token tensions + metrics--------------------'''
-def set_token_tensions(tokens):
-    for token in tokens:
-        other_token_idxs = get_matching_idxs(token, to_array(tokens))
-        other_tokens = tokens.take(other_token_idxs)
-        distances = [distance_between(token, other) for other in other_tokens]
-        # Total "spring force" of the other tokens
-        raw_tension = mean(distances)
-        # Net force which accounts for no room to move in direction of spring force (ie. there's a wall)
-        token.tension = 0
-        if raw_tension > 0 and has_room_right(token):
-            token.tension = raw_tension
-        elif raw_tension < 0 and has_room_left(token):
-            token.tension = raw_tension
-    
-    return tokens
-
-def get_matching_idxs(token, tokens):
-    a = to_array(tokens)
-    return [idx for idx in zip(
-                *np.where(a == token.val)
-        ) if idx != token.idx
-    ]
-
-def distance_between(token, other):
-    return other.col - token.col
-
-def entropy_of_col(tokens, icol):
-    col = [t.val for t in tokens[:, icol]]
-    counter = Counter(col)
-    total = sum([v for v in counter.values()])
-    probs = [count/total for count in counter.values()]
-    out = sum(-p*math.log(p) for p in probs)
-    return out
+def room_right(ids):
+    '''Mask of the cells with a BLANK somewhere to their right in the row.'''
+    blank = ids == BLANK
+    right = np.flip(np.logical_or.accumulate(np.flip(blank, 1), axis=1), 1)
+    return np.pad(right[:, 1:], ((0,0),(0,1)))
+
+def room_left(ids):
+    '''Mask of the cells with a BLANK somewhere to their left in the row.'''
+    left = np.logical_or.accumulate(ids == BLANK, axis=1)
+    return np.pad(left[:, :-1], ((0,0),(1,0)))
+
+def token_tensions(ids):
+    '''Tension of every token: the mean column distance to the other tokens with the same
+    value (the "spring force" pulling it), zeroed when there is no room to move in that
+    direction (ie. there's a wall). Blanks and unique tokens have no tension.'''
+    n_cols = ids.shape[1]
+    cols = np.broadcast_to(np.arange(n_cols), ids.shape)
+    counts = np.bincount(ids.ravel(), minlength=1)
+    col_sums = np.bincount(ids.ravel(), weights=cols.ravel(), minlength=1)
+    n_others = counts[ids] - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw = np.where(n_others > 0, (col_sums[ids] - cols)/n_others - cols, 0.)
+    raw[ids == BLANK] = 0.
+    return np.where(((raw > 0) & room_right(ids)) | ((raw < 0) & room_left(ids)), raw, 0.)
+
+def entropy_of_col(ids, icol):
+    counts = np.unique(ids[:, icol], return_counts=True)[1]
+    probs = counts/counts.sum()
+    return float(-(probs*np.log(probs)).sum())
+
+def total_entropy(ids):
+    return sum(entropy_of_col(ids, icol) for icol in range(ids.shape[1]))
+
+def _nlogn(n):
+    n = np.asarray(n, dtype=float)
+    return np.where(n > 0, n*np.log(np.where(n > 0, n, 1)), 0.)
+
+class ColumnCounts():
+    '''Count of every token id in every column of a token id matrix, and sum(n log n) over
+    the counts of each column. The entropy of a column of R rows is then
+    log(R) - nlogn/R, so entropy changes follow from count changes alone.'''
+    def __init__(self, ids, n_ids=None) -> None:
+        self.n_rows, self.n_cols = ids.shape
+        n_ids = int(ids.max(initial=0))+1 if n_ids is None else max(n_ids, int(ids.max(initial=0))+1)
+        cols = np.broadcast_to(np.arange(self.n_cols), ids.shape)
+        self.counts = np.bincount((cols*n_ids + ids).ravel(), minlength=self.n_cols*n_ids).reshape(self.n_cols, n_ids)
+        self.nlogn = _nlogn(self.counts).sum(axis=1)
+
+    def entropy(self):
+        '''Entropy of every column.'''
+        return np.log(self.n_rows) - self.nlogn/self.n_rows if self.n_rows else np.zeros(self.n_cols)
 
-def total_entropy(tokens):
-    return sum(entropy_of_col(tokens, icol) for icol in range(tokens.shape[1]))
+    def total_entropy(self):
+        return float(self.entropy().sum())
+
+    def changes(self, groups, cols, ids, deltas, n_groups=1):
+        '''Aggregate count changes (group, col, id, delta) per (group, col, id), where each
+        group is a separate hypothetical change of the matrix. Ids not counted yet (eg. merged
+        tokens that were not interned) start from 0. Returns (cols, ids, deltas, change of
+        nlogn) of every aggregated change and the total change of nlogn of every group.'''
+        width = max(self.counts.shape[1], int(ids.max(initial=0))+1)
+        keys, inverse = np.unique((groups.astype(np.int64)*self.n_cols + cols)*width + ids, return_inverse=True)
+        delta = np.bincount(inverse, weights=deltas, minlength=len(keys))
+        group, rest = np.divmod(keys, self.n_cols*width)
+        col, tid = np.divmod(rest, width)
+        known = tid < self.counts.shape[1]
+        base = np.where(known, self.counts[col, np.where(known, tid, 0)], 0)
+        dnlogn = _nlogn(base + delta) - _nlogn(base)
+        return col, tid, delta, dnlogn, np.bincount(group, weights=dnlogn, minlength=n_groups)
+
+    def _cell_changes(self, old, new):
+        changed = old != new
+        cols = np.broadcast_to(np.arange(self.n_cols), old.shape)[changed]
+        return (np.zeros(2*len(cols), dtype=np.int64), np.concatenate([cols, cols]),
+                np.concatenate([old[changed], new[changed]]), np.repeat([-1., 1.], len(cols)))
+
+    def diff_entropy(self, old, new):
+        '''Change of the total entropy from old to new (same shape), without applying it.'''
+        return float(-self.changes(*self._cell_changes(old, new))[4][0]/self.n_rows) if self.n_rows else 0.
+
+    def update(self, old, new):
+        '''Apply the change of the counted matrix from old to new (same shape), in
+        O(changed cells) apart from growing the table for new token ids.'''
+        col, tid, delta, dnlogn, _ = self.changes(*self._cell_changes(old, new))
+        if len(tid) and tid.max() >= self.counts.shape[1]:
+            self.counts = np.pad(self.counts, ((0,0),(0, int(tid.max())+1-self.counts.shape[1])))
+        self.counts[col, tid] += delta.astype(self.counts.dtype)
+        self.nlogn += np.bincount(col, weights=dnlogn, minlength=self.n_cols)
+
+def _candidate_gains(counts, batch, new, cand, n_cand):
+    '''Change of the total entropy of every candidate, where row i of batch becomes row i of
+    new under candidate cand[i].'''
+    changed = batch != new
+    groups = np.broadcast_to(cand[:, None], batch.shape)[changed]
+    cols = np.broadcast_to(np.arange(batch.shape[1]), batch.shape)[changed]
+    dnlogn = counts.changes(np.concatenate([groups, groups]), np.concatenate([cols, cols]),
+                            np.concatenate([batch[changed], new[changed]]), np.repeat([-1., 1.], len(cols)), n_cand)[4]
+    return -dnlogn/counts.n_rows
+
+def merge_gains(ids, vocab, counts=None):
+    '''Change of the total entropy from merge_next_cell at every (row, col), in one batch.
+    A merge of (a, b) merges every occurrence of the pair, so there is one candidate per
+    distinct pair, plus one per cell of a run like a a a that merging from the left would
+    skip (merging there first gives a different result). All rows holding each candidate's
+    pair are merged together in one batch and the resulting count changes are scored with
+    ColumnCounts.changes, touching only those rows. Merging a cell with a BLANK after it only
+    drops that blank and shifts the rest of its row left, so those cells are scored one row each.'''
+    n_rows, n_cols = ids.shape
+    gains = np.zeros((n_rows, max(n_cols-1, 0)))
+    if n_cols < 2 or n_rows == 0:
+        return gains
+    counts = ColumnCounts(ids, len(vocab)) if counts is None else counts
+
+    blank_rows, blank_cols = np.nonzero(ids[:, 1:] == BLANK)
+    if len(blank_rows):
+        batch = ids[blank_rows].astype(np.int64)
+        deleted = np.zeros(batch.shape, dtype=bool)
+        deleted[np.arange(len(blank_rows)), blank_cols+1] = True
+        gains[blank_rows, blank_cols] = _candidate_gains(counts, batch, compact_rows(batch, deleted), np.arange(len(blank_rows)), len(blank_rows))
+
+    cell_rows, cell_cols = np.nonzero(ids[:, 1:] != BLANK)
+    if len(cell_rows) == 0:
+        return gains
+    a, b = ids[cell_rows, cell_cols], ids[cell_rows, cell_cols+1]
+    # 1D int64 keys rather than np.unique(axis=0), which is much slower
+    width = int(ids.max())+1
+    pair_keys, cell_pair = np.unique(a.astype(np.int64)*width + b, return_inverse=True)
+    pairs = np.stack(np.divmod(pair_keys, width), axis=1)
+    # a merged token that is already in the vocabulary has counts to start from, others get a placeholder id
+    n_ids = max(len(vocab), counts.counts.shape[1])
+    merged = np.array([vocab.ids.get(f'{vocab[x]}-{vocab[y]}', n_ids+k) for k, (x, y) in enumerate(pairs.tolist())], dtype=np.int64)
+
+    pair_of = np.full((n_rows, n_cols-1), -1)
+    pair_of[cell_rows, cell_cols] = cell_pair
+    same_as_left = np.pad(pair_of[:, 1:] == pair_of[:, :-1], ((0,0),(1,0))) & (pair_of >= 0)
+    in_pair_run = same_as_left | np.pad(same_as_left[:, 1:], ((0,0),(0,1)))
+    greedy = alternate_runs(in_pair_run) | ~in_pair_run
+    skipped = ~greedy[cell_rows, cell_cols]
+
+    # candidates 0..K-1 are the pairs, K.. the skipped cells; rows_of[k] are the rows holding pair k
+    pair_rows = np.stack(np.divmod(np.unique(cell_pair.astype(np.int64)*n_rows + cell_rows), n_rows), axis=1)
+    starts = np.searchsorted(pair_rows[:, 0], np.arange(len(pairs)+1))
+    extra_pair = cell_pair[skipped]
+    n_extra_rows = starts[extra_pair+1] - starts[extra_pair]
+    extra_take = np.repeat(starts[extra_pair] - np.r_[0, np.cumsum(n_extra_rows)[:-1]], n_extra_rows) + np.arange(n_extra_rows.sum())
+
+    cand = np.concatenate([pair_rows[:, 0], len(pairs) + np.repeat(np.arange(len(extra_pair)), n_extra_rows)])
+    cand_pair = np.concatenate([pair_rows[:, 0], pair_rows[extra_take, 0]])
+    rows = np.concatenate([pair_rows[:, 1], pair_rows[extra_take, 1]])
+    chosen = np.full(len(rows), -1)
+    is_chosen_row = np.concatenate([np.zeros(len(pair_rows), bool), pair_rows[extra_take, 1] == np.repeat(cell_rows[skipped], n_extra_rows)])
+    chosen[is_chosen_row] = np.repeat(cell_cols[skipped], n_extra_rows)[is_chosen_row[len(pair_rows):]]
+
+    # same order of operations as merge_next_cell: the chosen cell first, then the rest from the left
+    batch = ids[rows].astype(np.int64)
+    first = np.zeros((len(rows), n_cols-1), dtype=bool)
+    first[np.nonzero(chosen >= 0)[0], chosen[chosen >= 0]] = True
+    new = _merge_cells(batch, first, merged[cand_pair])
+    new = _merge_cells(new, pair_mask(new, pairs[cand_pair, 0], pairs[cand_pair, 1]), merged[cand_pair])
+
+    cand_gain = _candidate_gains(counts, batch, new, cand, len(pairs) + len(extra_pair))
+
+    cell_cand = np.where(skipped, len(pairs) + np.cumsum(skipped) - 1, cell_pair)
+    gains[cell_rows, cell_cols] = cand_gain[cell_cand]
+    return gains
 
 '''------------------Helpers----------------------------'''
 def _get_direction(direction, left, right):
@@ -82,219 +260,185 @@ def _get_direction(direction, left, right):
 
     return direction
 
-def get_matching_idxs(token, tokens):
-    a = to_array(tokens)
-    return [idx for idx in zip(
-                *np.where(a == token.val)
-        ) if idx != token.idx
-    ]
+def merged_id(vocab, a, b):
+    '''Id of the token made of a followed by b (just a if b is BLANK).'''
+    return a if b == BLANK else vocab.intern(f'{vocab[a]}-{vocab[b]}')
 
 '''----------------Array manipulations--------------------'''
-def merge_next_col(tokens, icol):
+def merge_next_col(ids, vocab, icol):
     '''TODO: Needs to check that, if a column is already uniform, that no merge happens'''
-    out = to_array(tokens)
-    if icol+1 < out.shape[1]:
-        new_row = []
-        for a,b in zip(out[:, icol], out[:, icol+1]):
-            if b == '':
-                new_row.append(a)
-            else:
-                new_row.append(f'{a}-{b}')
-        out[:, icol] = np.array(new_row, dtype='U256')
-        out = np.delete(out, icol+1, 1)
-    else:
-        logging.debug(f'Next column {icol+1} does not exist in array with {out.shape[1]} columns. Will not attempt merge.')
-    return to_Tokens(out)
-
-def merge_next_cell(token, tokens, check_for_others=True):
-    '''TODO: Needs to check that, if a column is already uniform, that no merge happens.'''
-    irow, icol = token.idx
-    out = to_array(tokens)
-    if icol+1 < out.shape[0]:
-        if out[irow, icol+1] != '':
-            out[irow, icol] = f'{out[irow,icol]}-{out[irow,icol+1]}'
-
-        temp = np.delete(out[irow], icol+1)
-        out[irow] = np.append(temp, [''])
-
-        if check_for_others:
-            other_pair_idxs = other_merged_pairs(out[irow, icol], tokens)
-            for other_idx in other_pair_idxs:
-                out = merge_next_cell(tokens[other_idx], tokens, False)
-
-    else:
-        logging.debug(f'Next column {icol+1} does not exist in array with {out.shape[1]} columns. Will not attempt merge.')
-    
-    return to_Tokens(out)
-
-def other_merged_pairs(val, tokens):
-    a = to_array(tokens)
-    n_lists, n_tokens = a.shape
-    out = []
-    for irow, icol in itertools.product(range(n_lists), range(n_tokens-1)):
-        if a[irow, icol+1] != '':
-            pair = f'{a[irow, icol]}-{a[irow, icol+1]}'
-        else:
-            pair = a[irow, icol]
-        if pair == val:
-            out.append((irow,icol))
+    if icol+1 >= ids.shape[1]:
+        logging.debug(f'Next column {icol+1} does not exist in array with {ids.shape[1]} columns. Will not attempt merge.')
+        return ids.copy()
+
+    # every distinct pair is interned once, then mapped back to the rows
+    pairs, inverse = np.unique(ids[:, icol:icol+2], axis=0, return_inverse=True)
+    merged = np.array([merged_id(vocab, a, b) for a, b in pairs.tolist()], dtype=ids.dtype)
+    out = np.delete(ids, icol+1, 1)
+    out[:, icol] = merged[inverse.ravel()]
+    return out
 
+def merge_next_cell(ids, vocab, irow, icol, check_for_others=True):
+    '''Merge cell (irow, icol) with the next one in its row and shift the rest of the row left.
+    With check_for_others, every other occurrence of the same pair is merged too.
+    TODO: Needs to check that, if a column is already uniform, that no merge happens.'''
+    if icol+1 >= ids.shape[1]:
+        logging.debug(f'Next column {icol+1} does not exist in array with {ids.shape[1]} columns. Will not attempt merge.')
+        return ids.copy()
+
+    a, b = ids[irow, icol], ids[irow, icol+1]
+    merge = np.zeros((ids.shape[0], ids.shape[1]-1), dtype=bool)
+    merge[irow, icol] = True
+    out = _merge_cells(ids, merge, merged_id(vocab, a, b))
+    # the others are looked for after the first merge so that it wins over overlapping ones
+    # (merging a token with a BLANK only shifts the blank, so there is nothing else to do)
+    if check_for_others and b != BLANK:
+        out = _merge_cells(out, pair_mask(out, a, b), merged_id(vocab, a, b))
     return out
 
-def has_room_right(token, tokens):
-    return has_room(token, tokens, direction='r')
-def has_room_left(token, tokens):
-    return has_room(token, tokens, direction='l')
-def has_room(token, tokens, direction='', left=False, right=False):
+def _merge_cells(ids, merge, new_id):
+    '''Replace the cells in merge by new_id (a scalar or one per row) and drop the cells after them.'''
+    out = ids.copy()
+    out[:, :-1][merge] = np.broadcast_to(_per_row(new_id), merge.shape)[merge]
+    return compact_rows(out, np.pad(merge, ((0,0),(1,0))))
+
+def has_room_right(ids, irow, icol):
+    return has_room(ids, irow, icol, direction='r')
+def has_room_left(ids, irow, icol):
+    return has_room(ids, irow, icol, direction='l')
+def has_room(ids, irow, icol, direction='', left=False, right=False):
     d = _get_direction(direction, left, right)
-    irow, icol = token.idx
-    a = to_array(tokens)
     if d == 'r':
-        if (a[irow,icol+1:] == '').any():
-            return True
-        else:
-            return False
+        return bool((ids[irow, icol+1:] == BLANK).any())
     elif d == 'l':
-        if (a[irow,:icol] == '').any():
-            return True
-        else:
-            return False
-
-def nearest_blank_left(token, tokens):
-    return nearest_blank(token, tokens, direction='l')   
-def nearest_blank_right(token, tokens):
-    return nearest_blank(token, tokens, direction='r')
-def nearest_blank(token, tokens, direction='', left=False, right=False):
+        return bool((ids[irow, :icol] == BLANK).any())
+
+def nearest_blank_left(ids, irow, icol):
+    return nearest_blank(ids, irow, icol, direction='l')
+def nearest_blank_right(ids, irow, icol):
+    return nearest_blank(ids, irow, icol, direction='r')
+def nearest_blank(ids, irow, icol, direction='', left=False, right=False):
+    '''Column of the nearest BLANK in the given direction, or None.'''
     d = _get_direction(direction, left, right)
-    irow, icol = token.idx
-    a = to_array(tokens)
     if d == 'r':
-        all_right_idxs = list(
-            zip(
-                *np.where(a[irow, icol+1:] == '')
-            )
-        )
-        return all_right_idxs[0]
-    
+        blanks = np.flatnonzero(ids[irow, icol+1:] == BLANK)
+        return icol+1+blanks[0] if len(blanks) else None
     elif d == 'l':
-        all_left_idxs = list(
-            zip(
-                *np.where(a[irow, :icol] == '')
-            )
-        )
-        return all_left_idxs[-1]
-
-def slide_token(token, tokens, direction='', left=False, right=False):
-    d = _get_direction(direction, left, right)
-    irow, icol = token.idx
-    out = to_array(tokens)
-
-    next_blank_idx = nearest_blank(tokens, irow, icol, d)
+        blanks = np.flatnonzero(ids[irow, :icol] == BLANK)
+        return blanks[-1] if len(blanks) else None
 
-    if d == 'r':
-        if has_room_right(token, tokens):
-            new_row = out[irow, icol:next_blank_idx]
-            out[irow, icol+1:next_blank_idx+1] = new_row
-            out[irow, icol] = ''
-        else:
-            logging.debug(f'Cannot move right because there are no empty tokens to use. {out[irow]}')
-    
+def slide_token(ids, irow, icol, direction='', left=False, right=False):
+    '''Move the token at (irow, icol) one column, pushing its neighbours into the nearest blank.'''
+    d = _get_direction(direction, left, right)
+    out = ids.copy()
+    next_blank_idx = nearest_blank(ids, irow, icol, d)
+    if next_blank_idx is None:
+        logging.debug(f'Cannot move {"right" if d == "r" else "left"} because there are no empty tokens to use. {ids[irow]}')
+    elif d == 'r':
+        out[irow, icol+1:next_blank_idx+1] = ids[irow, icol:next_blank_idx]
+        out[irow, icol] = BLANK
     elif d == 'l':
-        if has_room_left(token):
-            new_row = out[irow, next_blank_idx+1:icol+1]
-            out[irow, next_blank_idx:icol] = new_row
-            out[irow, icol] = ''
-        else:
-            logging.debug(f'Cannot move left because there are no empty tokens to use. {out[irow]}')
+        out[irow, next_blank_idx:icol] = ids[irow, next_blank_idx+1:icol+1]
+        out[irow, icol] = BLANK
+
+    return out
 
 '''--------------------------Classes------------------------------'''
 class TokenArray():
+    '''Structure of arrays over the tokenized items: the token id matrix (see tokenize),
+    the tension of every token and the mask of frozen tokens (those in a uniform column).
+    Tokens are only materialized as Token views on request.'''
     def __init__(self, list_of_strs) -> None:
         self.raw_items = list_of_strs
-        self.tokens = to_Tokens(tokenize(self.raw_items))
-        self.frozen_idxs = []
+        ids, self.lengths, self.vocab = tokenize(self.raw_items)
+        self.frozen = np.zeros(ids.shape, dtype=bool)
+        self.counts = None
+        self._set_ids(ids)
+
+    def _set_ids(self, ids):
+        # column counters follow cell changes; only a change of shape (merge_next_col, drop_col) recounts
+        if self.counts is not None and ids.shape == self.ids.shape:
+            self.counts.update(self.ids, ids)
+        else:
+            self.counts = ColumnCounts(ids, len(self.vocab))
+        self.ids = ids
+        self.tension = token_tensions(ids)
+
+    @property
+    def shape(self):
+        return self.ids.shape
 
     @property
     def a(self):
-        return to_array(self.tokens)
+        return self.vocab.decode(self.ids)
+
+    def token(self, irow, icol):
+        return Token(self, irow, icol)
 
-    def inplace(self, new_tokens, flag, bypass_sanity=False):
+    def __getitem__(self, idx):
+        return self.token(*idx)
+
+    def inplace(self, new_ids, flag, bypass_sanity=False):
         if flag:
-            self.tokens = self.sanity(new_tokens, bypass_sanity) # this is the only place self.tokens is modified!
+            self._set_ids(self.sanity(new_ids, bypass_sanity)) # this is the only place self.ids is modified!
             return None
         else:
-            return new_tokens
+            return new_ids
 
-    def sanity(self, new_tokens, bypass_sanity):
+    def sanity(self, new_ids, bypass_sanity):
         # Check no currently frozen Tokens are changing
         if not bypass_sanity:
-            for idx in self.frozen_idxs:
-                if self.a[idx] != to_array(new_tokens)[idx]:
-                    logging.warning('New tokens did not pass sanity check. Modified a frozen value at %s. Printing current array:\n%s'%(idx, self.a))
-                    return self.tokens
+            n_cols = min(self.ids.shape[1], new_ids.shape[1])
+            frozen = self.frozen[:, :n_cols]
+            if (self.ids[:, :n_cols][frozen] != new_ids[:, :n_cols][frozen]).any():
+                logging.warning('New tokens did not pass sanity check. Modified a frozen value. Printing current array:\n%s'%(self.a))
+                return self.ids
         
         # Look for new frozen tokens and freeze them
-        self.frozen_idxs = [] # need to reset in the case that a frozen column shifted from merge_next_col
-        for icol in range(new_tokens.shape[1]):
-            col = new_tokens[:, icol]
-            if (col == col[0]).all():
-                for irow in range(new_tokens.shape[0]):
-                    self.frozen_idxs.append((irow, icol))
-
-        return new_tokens
+        # (recomputed from scratch in the case that a frozen column shifted from merge_next_col)
+        self.frozen = np.broadcast_to((new_ids == new_ids[:1]).all(axis=0), new_ids.shape).copy()
+        return new_ids
 
     '''============ Entropy =================='''
     def entropy_of_col(self, icol):
-        return entropy_of_col(self.tokens, icol)
+        return float(self.counts.entropy()[icol])
 
     def total_entropy(self):
-        return total_entropy(self.tokens)
+        return self.counts.total_entropy()
 
-    def diff_entropy(self, new_tokens):
+    def diff_entropy(self, new_ids):
         # Negative if new tokens are better (entropy decreases)
-        return total_entropy(new_tokens) - self.total_entropy()
+        if new_ids.shape == self.ids.shape:
+            return self.counts.diff_entropy(self.ids, new_ids)
+        return total_entropy(new_ids) - self.total_entropy()
 
-    def entropy_per_merge(self, token_array=None):
-        if token_array is None:
-            token_array = self.tokens
-
-        n_lists, n_tokens = token_array.shape
-        entropy_gain_per_merge = np.zeros((n_lists,n_tokens-1))
-        for ilist, itkn in itertools.product(range(n_lists), range(n_tokens-1)):
-            new_tokens = merge_next_cell(token_array[ilist,itkn], token_array)
-            entropy_gain_per_merge[ilist, itkn] = self.diff_entropy(new_tokens)
-
-        return entropy_gain_per_merge
+    def entropy_per_merge(self, ids=None):
+        '''diff_entropy of merge_next_cell at every (row, col), see merge_gains.'''
+        if ids is None or ids is self.ids:
+            return merge_gains(self.ids, self.vocab, self.counts)
+        return merge_gains(ids, self.vocab)
 
     '''=============== Tension ====================='''
     def connection_tension(self, token, k=1):
-        return k * distance_between(token, self.tokens)/self.tokens.shape[1]
+        return k * self.tension[token.idx]/self.ids.shape[1]
 
     def compression_force(self, token, k=1):
         left_compression, l_idxs_to_merge = 0, None
         right_compression, r_idxs_to_merge = 0, None
         merge_possibilities = self.entropy_per_merge()[token.row]
 
-        if not has_room_right(token, self.tokens):
+        if not has_room_right(self.ids, *token.idx):
             right_half = merge_possibilities[token.col:]
             if (right_half < 0).any():
-                best_compress_idxs = list(
-                    zip(
-                        *np.where(right_half == right_half.min())
-                    )
-                )
-                right_compression = sum(right_half.take(best_compress_idxs))
+                best_compress_idxs = np.flatnonzero(right_half == right_half.min())
+                right_compression = right_half[best_compress_idxs].sum()
                 r_idxs_to_merge = best_compress_idxs+token.col # convert back to merge_possibilities indexing
 
-        if not has_room_left(token, self.tokens):
+        if not has_room_left(self.ids, *token.idx):
             left_half = merge_possibilities[:token.col]
             if (left_half < 0).any():
-                best_compress_idxs = list(
-                    zip(
-                        *np.where(left_half == left_half.min())
-                    )
-                )
-                left_compression = sum(left_half.take(best_compress_idxs))
+                best_compress_idxs = np.flatnonzero(left_half == left_half.min())
+                left_compression = left_half[best_compress_idxs].sum()
                 l_idxs_to_merge = best_compress_idxs # already in merge_possibilities indexing
 
         return k*right_compression, k*left_compression, l_idxs_to_merge, r_idxs_to_merge
@@ -302,36 +446,53 @@ class TokenArray():
 
     '''============ Manipulations =================='''
     def merge_next_cell(self, token, in_place=False):
-        result = merge_next_cell(token, self.tokens)
+        result = merge_next_cell(self.ids, self.vocab, *token.idx)
         return self.inplace(result, in_place)
 
     def merge_next_col(self, icol, in_place=False):
-        result = merge_next_col(self.tokens, icol)
+        result = merge_next_col(self.ids, self.vocab, icol)
         return self.inplace(result, in_place, True)
 
     def slide_token_right(self, token, in_place=False):
-        result = slide_token(token, self.tokens, 'r')
+        result = slide_token(self.ids, *token.idx, 'r')
         return self.inplace(result, in_place)
             
     def slide_token_left(self, token, in_place=False):
-        result = slide_token(token, self.tokens, 'l')
+        result = slide_token(self.ids, *token.idx, 'l')
         return self.inplace(result, in_place)
 
     def drop_col(self, icol, in_place=False):
-        result = np.delete(self.tokens, icol, 1)
+        result = np.delete(self.ids, icol, 1)
         return self.inplace(result, in_place)
 
 class Token():
-    def __init__(self, row, col, val) -> None:
+    '''View of one cell of a TokenArray. Only the position is stored, the value, tension
+    and frozen state are read from the array.'''
+    def __init__(self, array, row, col) -> None:
+        self.array = array
         self.row = row
         self.col = col
-        self.val = val
-        self.tension = 0
 
     @property
     def idx(self):
         return (self.row, self.col)
 
+    @property
+    def id(self):
+        return self.array.ids[self.idx]
+
+    @property
+    def val(self):
+        return self.array.vocab[self.id]
+
+    @property
+    def tension(self):
+        return self.array.tension[self.idx]
+
+    @property
+    def frozen(self):
+        return self.array.frozen[self.idx]
+
 if __name__ == '__main__':
     test_strs = [
         # "THselection_Data_16.root",
@@ -1,13 +1,20 @@
 from functools import reduce
 import glob
-import subprocess, uproot, time, tqdm, os, io, itertools, vector
-import tarfile
+import subprocess, uproot, time, tqdm, os, itertools, vector, hashlib
+import base64, tarfile, sqlite3, zipfile, mmap, struct, tempfile, operator, copy, json, platform, resource, threading
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
+import awkward as ak
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 import dask as dd
-from dask.distributed import Client
+import dask.dataframe
 from sqlalchemy import create_engine
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import logging
 import plotly.express as px
 
@@ -23,21 +30,15 @@ def ttree_keys(file):
 
     return out 
 
-def get_collection_dict(file, ttree_name):
-    tree = file[ttree_name]
-    edm_filter = lambda b: 'edm::' not in b.typename
-
-    if len(tree.keys(filter_branch=edm_filter)) == 0:
-        return 'Cound not open TTree due to unsupported branches in edm namespace.'
-
-    branch_names = tree.keys(filter_branch=edm_filter) 
+SCHEMA_CACHE_DIR = os.path.expanduser('~/.cache/relational_nano/schemas')
+_schema_cache = {}
 
+def infer_collection_dict(typenames):
+    '''Group {branch name: typename} into {collection: [variables]}. Branches that are not
+    arrays go to the "event" collection, except for the n{coll} counters which are dropped.'''
     out = defaultdict(list)
-    print ('Getting collection dict...')
-    for branch_name in tqdm.tqdm(branch_names):
-        has_many = tree.typenames()[branch_name].endswith('[]')
-        
-        if not has_many:
+    for branch_name, typename in typenames.items():
+        if not typename.endswith('[]'):
             out['event'].append(branch_name)
 
         else:
@@ -48,18 +49,182 @@ def get_collection_dict(file, ttree_name):
 
             out[collection].append(variable)
 
-    for coll_name in out.keys():
-        while f'n{coll_name}' in out['event']:
-            out['event'].remove(f'n{coll_name}')
+    counters = set(f'n{coll_name}' for coll_name in out.keys())
+    out['event'] = [branch_name for branch_name in out['event'] if branch_name not in counters]
+    return out
+
+def schema_hash(typenames):
+    return hashlib.sha1(json.dumps(list(typenames.items())).encode()).hexdigest()
+
+def get_collection_dict(file, ttree_name, cache_dir=SCHEMA_CACHE_DIR):
+    '''Collection dict of a TTree (see infer_collection_dict). The result is cached in memory
+    and as JSON in cache_dir (None to disable), keyed by a hash of the branch names and
+    typenames, so every file sharing a tree layout reuses the first inference.'''
+    tree = file[ttree_name]
+    edm_filter = lambda b: 'edm::' not in b.typename
+    typenames = tree.typenames(filter_branch=edm_filter)
+
+    if len(typenames) == 0:
+        return 'Cound not open TTree due to unsupported branches in edm namespace.'
+
+    key = schema_hash(typenames)
+    if key in _schema_cache:
+        return defaultdict(list, {c: list(v) for c, v in _schema_cache[key].items()})
+
+    cache_file = None if cache_dir is None else os.path.join(cache_dir, f'{key}.json')
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            out = defaultdict(list, json.load(f))
+    else:
+        logging.debug(f'Inferring collection dict of {ttree_name} ({len(typenames)} branches)')
+        out = infer_collection_dict(typenames)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp', delete=False) as f:
+                json.dump(out, f)
+            os.replace(f.name, cache_file) # atomic so that parallel workers never read a partial file
+
+    _schema_cache[key] = defaultdict(list, {c: list(v) for c, v in out.items()})
+    return out
+
+def broadcast_event_index(event_array, nobj_array):
+    '''Expand per-event numbers to per-object rows using the n{coll} counts.
+    Returns the event number and the local (within event) index of every object.'''
+    nobj_array = np.asarray(nobj_array, dtype=np.int64)
+    event = np.repeat(event_array, nobj_array)
+    starts = np.cumsum(nobj_array) - nobj_array
+    object_idx = (np.arange(nobj_array.sum()) - np.repeat(starts, nobj_array)).astype(np.int32)
+    return event, object_idx
+
+def bench_event_broadcast(sizes=(10**4, 10**5, 10**6, 10**7), mean_nobj=4, seed=0):
+    '''Regression benchmark for broadcast_event_index. Time per event should stay
+    flat as the event count grows (ie. total time is linear in the number of events).'''
+    rng = np.random.default_rng(seed)
+    out = {}
+    for nevents in sizes:
+        event_array = np.arange(nevents, dtype=np.uint64)
+        nobj_array = rng.poisson(mean_nobj, nevents).astype(np.int32)
+        start = time.perf_counter()
+        broadcast_event_index(event_array, nobj_array)
+        out[nevents] = time.perf_counter() - start
+        logging.info(f'{nevents} events: {out[nevents]:.4f} s ({1e9*out[nevents]/nevents:.1f} ns/event)')
 
     return out
 
+def collection_branch_names(coll_name, val_names):
+    if coll_name == 'event' or coll_name == val_names[0]:
+        return list(val_names)
+    else:
+        return [f'{coll_name}_{val_name}' for val_name in val_names]
+
+def _smallest_int_dtype(a):
+    '''Narrowest integer dtype holding every value of a (unsigned if nothing is negative).'''
+    lo, hi = a.min(), a.max()
+    for dtype in ((np.uint8, np.uint16, np.uint32, np.uint64) if lo >= 0 else (np.int8, np.int16, np.int32, np.int64)):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return a.dtype
+
+def optimized_dtype(a, value_based=True):
+    '''Target dtype of one column: booleans become a bit-packed Arrow bitmap, integers are
+    narrowed to their value range and float64 becomes float32 only when that is lossless (float32
+    branches are never widened). Columns stay numeric so that they can be compared and summed in
+    pandas; low-cardinality columns are dictionary encoded by the Parquet writer instead.
+    With value_based=False only the value-independent part is applied, so every chunk of a
+    streamed tree gets the same schema.'''
+    kind = a.dtype.kind
+    if kind == 'b':
+        return pd.ArrowDtype(pa.bool_())
+    if kind not in 'iuf' or not value_based or len(a) == 0:
+        return a.dtype
+
+    if kind in 'iu':
+        dtype = _smallest_int_dtype(a)
+    elif a.dtype == np.float64 and np.array_equal(a.astype(np.float32), a, equal_nan=True):
+        dtype = np.dtype(np.float32)
+    else:
+        dtype = a.dtype
+    return dtype
+
+def optimize_dtypes(df, value_based=True):
+    '''Cast every column of df to optimized_dtype(). Returns the new DataFrame and the number
+    of bytes saved in memory.'''
+    before = df.memory_usage(index=False, deep=True).sum()
+    df = df.astype({c: optimized_dtype(df[c].to_numpy(), value_based) for c in df.columns})
+    return df, int(before - df.memory_usage(index=False, deep=True).sum())
+
+def collection_to_frame(arrays, coll_name, val_names, nano=False, event_array=None, nobj_array=None, value_based=True):
+    '''Build the DataFrame of one collection from branch arrays that were already read
+    (either the full tree or one chunk of tree.iterate()) and compact its dtypes (see
+    optimize_dtypes). The bytes saved are kept in df.attrs['bytes_saved'].'''
+    branch_names = collection_branch_names(coll_name, val_names)
+    if (coll_name != 'event') and nano:
+        columns = {}
+        for branch_name in branch_names:
+            if '_' in branch_name:
+                val_name = branch_name.split('_',1)[1] # rename to be just 'pt' instead of 'Electron_pt'
+            else:
+                val_name = branch_name
+            columns[val_name] = np.hstack(arrays[branch_name])
+
+        columns['event'], columns['object_idx'] = broadcast_event_index(event_array, nobj_array)
+
+    else:
+        columns = {branch_name: arrays[branch_name] for branch_name in branch_names}
+
+    df, saved = optimize_dtypes(pd.DataFrame(columns), value_based)
+    df.attrs['bytes_saved'] = saved
+    logging.debug(f'{coll_name}: dtype optimization saved {saved/1e6:.2f} MB')
+    return df
+
+def table_keys(columns):
+    '''Key columns of a relational table. Event tables are keyed on (run, luminosityBlock, event)
+    and object tables on (event, object_idx). Tables without an event column have no key.'''
+    if 'event' not in columns:
+        return []
+    elif 'object_idx' in columns:
+        return ['event', 'object_idx']
+    else:
+        return [c for c in ['run', 'luminosityBlock', 'event'] if c in columns]
+
+def event_sort_order(columns):
+    # event first so that the event-sorted layout is the same for event and object tables
+    keys = table_keys(columns)
+    return ['event'] + [k for k in keys if k != 'event'] if keys else []
+
+def _sort_order(columns, sort_by=None):
+    if sort_by and all(c in columns for c in sort_by):
+        return list(sort_by)
+    return event_sort_order(columns)
+
+def sort_by_keys(df, sort_by=None):
+    '''Sort by event (see event_sort_order) or, if all of them are columns of df, by the sort_by columns.'''
+    order = _sort_order(df.columns, sort_by)
+    return df.sort_values(order, kind='stable', ignore_index=True) if order else df
+
+def parquet_sorting_columns(columns, sort_by=None):
+    columns = list(columns)
+    return [pq.SortingColumn(columns.index(k)) for k in _sort_order(columns, sort_by)]
+
+def sort_arrow_table(table, sort_by=None):
+    '''Arrow counterpart of sort_by_keys(). A table that is already in order is returned as
+    is, so its buffers are not copied by take().'''
+    order = _sort_order(table.column_names, sort_by)
+    if not order:
+        return table
+    indices = pc.sort_indices(table, sort_keys=[(k, 'ascending') for k in order])
+    if np.array_equal(indices.to_numpy(), np.arange(len(table))):
+        return table
+    return table.take(indices)
+
 def extract_to_collections(file, ttree_name, nano=False):
     collection_dict = get_collection_dict(file, ttree_name)
     if isinstance(collection_dict, str):
         return None
 
     tree = file[ttree_name]
+    event_array, nobj_array = None, None
     if nano:
         event_array = tree['event'].array(library='np')
     
@@ -70,134 +235,1083 @@ def extract_to_collections(file, ttree_name, nano=False):
         pbar.set_description(coll_name)
 
         if (coll_name != 'event') and nano:
-            if coll_name != val_names[0]:
-                branch_names = [f'{coll_name}_{val_name}' for val_name in val_names]
-            else:
-                branch_names = [coll_name]
-
             nobj_array = tree[f'n{coll_name}'].array(library='np')
-            arrays = tree.arrays(branch_names, library='np')
 
-            arrays['event'] = np.array([], dtype='object')
-            for event, nobj in zip(event_array, nobj_array):
-                arrays['event'] = np.append(arrays['event'], np.array([event]*nobj, dtype=np.uint64) )
+        arrays = tree.arrays(collection_branch_names(coll_name, val_names), library='np')
+        out[coll_name] = collection_to_frame(arrays, coll_name, val_names, nano, event_array, nobj_array)
+
+    logging.info(f'{ttree_name}: dtype optimization saved {sum(df.attrs["bytes_saved"] for df in out.values())/1e6:.2f} MB')
+    return out
+
+def _selected_collections(file, ttree_name, collections=None):
+    collection_dict = get_collection_dict(file, ttree_name)
+    if isinstance(collection_dict, str):
+        return None
+    if collections is not None:
+        collection_dict = {c: v for c, v in collection_dict.items() if c in collections}
+    return collection_dict
+
+def _iterate_branches(collection_dict, nano=False, counts=True):
+    branch_names = set(['event']) if nano else set()
+    for coll_name, val_names in collection_dict.items():
+        branch_names.update(collection_branch_names(coll_name, val_names))
+        if counts and (coll_name != 'event') and nano:
+            branch_names.add(f'n{coll_name}')
+    return sorted(branch_names)
+
+def iterate_collections(file, ttree_name, nano=False, step_size='100 MB', collections=None):
+    '''Stream the TTree with uproot's iterate() and yield one {collection: DataFrame}
+    dict per chunk. step_size is either a number of entries or a size string
+    like "100 MB". Only one chunk of every branch is held in memory at a time. Chunks only
+    get the value-independent dtype optimizations so that they all share one schema.'''
+    collection_dict = _selected_collections(file, ttree_name, collections)
+    if collection_dict is None:
+        return
 
-            branch_names = list(arrays.keys())
-            for branch_name in branch_names:
-                if '_' in branch_name:
-                    val_name = branch_name.split('_',1)[1] # rename to be just 'pt' instead of 'Electron_pt'
+    tree = file[ttree_name]
+    for arrays in tree.iterate(_iterate_branches(collection_dict, nano), step_size=step_size, library='np'):
+        yield {
+            coll_name: collection_to_frame(arrays, coll_name, val_names, nano, arrays.get('event'), arrays.get(f'n{coll_name}'), value_based=False)
+            for coll_name, val_names in collection_dict.items()
+        }
+
+def arrow_collection_table(arrays, coll_name, val_names, nano=False):
+    '''Arrow counterpart of collection_to_frame() for branches read with library='ak'.
+    Jagged branches are split into offsets and flat content, and the content buffers are
+    wrapped as Arrow arrays without a copy (booleans excepted, Arrow packs them into a
+    bitmap). Only the event and object_idx columns are new allocations.'''
+    branch_names = collection_branch_names(coll_name, val_names)
+    if (coll_name != 'event') and nano:
+        columns = {}
+        for branch_name in branch_names:
+            layout = ak.to_packed(arrays[branch_name]).layout # no-op for the ListOffsetArrays uproot builds
+            offsets = layout.offsets.data
+            val_name = branch_name.split('_',1)[1] if '_' in branch_name else branch_name
+            columns[val_name] = pa.array(layout.content.data)
+
+        event, object_idx = broadcast_event_index(np.asarray(arrays['event']), np.diff(offsets))
+        columns['event'], columns['object_idx'] = pa.array(event), pa.array(object_idx)
+
+    elif nano:
+        columns = {branch_name: pa.array(np.asarray(arrays[branch_name])) for branch_name in branch_names}
+    else:
+        columns = {branch_name: ak.to_arrow(arrays[branch_name], extensionarray=False) for branch_name in branch_names}
+
+    return pa.table(columns)
+
+def iterate_arrow_tables(file, ttree_name, nano=False, step_size='100 MB', collections=None):
+    '''Like iterate_collections() but yields {collection: pyarrow.Table} built by
+    arrow_collection_table(), so no pandas objects are created on the way to Parquet.'''
+    collection_dict = _selected_collections(file, ttree_name, collections)
+    if collection_dict is None:
+        return
+
+    tree = file[ttree_name]
+    for arrays in tree.iterate(_iterate_branches(collection_dict, nano, counts=False), step_size=step_size, library='ak'):
+        yield {
+            coll_name: arrow_collection_table(arrays, coll_name, val_names, nano)
+            for coll_name, val_names in collection_dict.items()
+        }
+
+def stream_to_parquet(input_file, ttree_key, output_name, step_size='100 MB', collections=None, row_group_size=None, sort_by=None, engine='pandas'):
+    '''Write every chunk of iterate_collections() as a new row group (or several, if
+    longer than row_group_size) of the per-collection Parquet file. Each row group is
+    sorted by event (the whole file is too as long as the input tree is) unless sort_by
+    gives other columns (list or {collection: list}), eg. to make the min/max statistics
+    of a column selective for filtered reads. With engine='arrow' the chunks come from
+    iterate_arrow_tables() instead. Files are written as <name>.tmp and only renamed once
+    the whole tree went through, so a failure never leaves a truncated file under the final
+    name. Returns the list of files written.'''
+    writers = {}
+    try:
+        nano = ttree_key == 'Events'
+        iterate = iterate_arrow_tables if engine == 'arrow' else iterate_collections
+        for chunk in iterate(input_file, ttree_key, nano, step_size, collections):
+            for collection, data in chunk.items():
+                coll_sort_by = _for_collection(sort_by, collection)
+                if engine == 'arrow':
+                    table = sort_arrow_table(data, coll_sort_by)
                 else:
-                    val_name = branch_name
-                arrays[val_name] = np.hstack(arrays.pop(branch_name))
+                    table = pa.Table.from_pandas(sort_by_keys(data, coll_sort_by), preserve_index=False)
+                if collection not in writers:
+                    writers[collection] = pq.ParquetWriter(f'{output_name}{ttree_key}_{collection}.parquet.tmp', table.schema,
+                                                           write_statistics=True, sorting_columns=parquet_sorting_columns(table.column_names, coll_sort_by))
+                writers[collection].write_table(table, row_group_size=row_group_size)
+    except BaseException:
+        for writer in writers.values():
+            writer.close()
+            os.remove(writer.where)
+        raise
+
+    out = []
+    for writer in writers.values():
+        writer.close()
+        os.replace(writer.where, writer.where[:-len('.tmp')])
+        out.append(writer.where[:-len('.tmp')])
+    return out
 
-            out[coll_name] = pd.DataFrame(arrays)
+def file_checksum(filename, block_size=1<<24):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
 
+def input_state(filename, recorded=None):
+    '''Identity of an input file as {file, size, mtime, checksum} and whether it differs from
+    the recorded one. The checksum is only recomputed if size or mtime changed, so a file that
+    was touched but not modified does not count as changed.'''
+    stat = os.stat(filename)
+    state = {'file': os.path.abspath(filename), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if recorded is not None and all(recorded.get(k) == state[k] for k in ('file', 'size', 'mtime')):
+        return dict(state, checksum=recorded['checksum']), False
+
+    state['checksum'] = file_checksum(filename)
+    return state, input_changed(state, recorded)
+
+def input_changed(state, recorded):
+    '''Whether the input state differs from the recorded one (see input_state).'''
+    return recorded is None or any(recorded.get(k) != state[k] for k in ('file', 'size', 'checksum'))
+
+def recorded_input(manifest_paths):
+    '''Input state recorded in the first readable ConversionManifest of manifest_paths, or None.
+    Used to compute the state of a file once for all its units without losing the size and
+    mtime shortcut of input_state.'''
+    for path in manifest_paths:
+        try:
+            with open(path) as f:
+                return json.load(f)['input']
+        except (OSError, ValueError, KeyError):
+            continue
+    return None
+
+def chunk_ranges(tree, branch_names, step_size=None):
+    '''(entry_start, entry_stop) chunks of tree. step_size is a number of entries, a size
+    string like "100 MB" (converted with the branches given) or None for one chunk.'''
+    if step_size is None:
+        step = tree.num_entries
+    elif isinstance(step_size, str):
+        step = tree.num_entries_for(step_size, branch_names)
+    else:
+        step = int(step_size)
+    step = max(step, 1)
+    return [(start, min(start+step, tree.num_entries)) for start in range(0, tree.num_entries, step)]
+
+def read_collection_chunk(tree, coll_name, val_names, nano=False, entry_start=None, entry_stop=None, engine='pandas', value_based=False):
+    '''One collection of an entry range of tree, as a DataFrame (engine='pandas') or a
+    pyarrow.Table (engine='arrow').'''
+    branch_names = _iterate_branches({coll_name: val_names}, nano, counts=engine != 'arrow')
+    if engine == 'arrow':
+        arrays = tree.arrays(branch_names, entry_start=entry_start, entry_stop=entry_stop, library='ak')
+        return arrow_collection_table(arrays, coll_name, val_names, nano)
+
+    arrays = tree.arrays(branch_names, entry_start=entry_start, entry_stop=entry_stop, library='np')
+    return collection_to_frame(arrays, coll_name, val_names, nano, arrays.get('event'), arrays.get(f'n{coll_name}'), value_based)
+
+class ConversionManifest():
+    '''Progress of one (file, tree, collection) conversion unit, kept as JSON next to its
+    output. The unit is split into entry-range chunks and a chunk is only marked done once
+    its output is in place, so a crash loses at most the chunk being written. Progress is
+    thrown away (self.stale) if the input changed or the chunking or options differ.
+    state is the input state of filename if the caller already has it (see input_state).'''
+    def __init__(self, path, filename, tree, collection, ranges, options, state=None) -> None:
+        self.path = path
+        previous = None
+        if os.path.exists(path):
+            with open(path) as f:
+                previous = json.load(f)
+
+        unit = json.loads(json.dumps({'tree': tree, 'collection': collection, 'ranges': ranges, 'options': options}))
+        recorded = previous['input'] if previous else None
+        if state is None:
+            self.input, changed = input_state(filename, recorded)
         else:
-            if coll_name == 'event' or coll_name == val_names[0]:
-                arrays = tree.arrays(val_names, library='np')
-            else:
-                arrays = tree.arrays([f'{coll_name}_{val_name}' for val_name in val_names], library='np')
+            self.input, changed = state, input_changed(state, recorded)
+        self.stale = previous is None or changed or any(previous[k] != v for k, v in unit.items())
+        self.state = dict(unit, input=self.input, chunks={}, output=None, complete=False)
+        if not self.stale:
+            self.state.update(chunks=previous['chunks'], output=previous['output'], complete=previous['complete'])
+        self.save()
 
-        for k,a in arrays.items():
-            if a.dtype == np.uint64:
-                arrays[k] = a.astype(np.uint32)
+    def save(self):
+        with open(self.path+'.tmp', 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(self.path+'.tmp', self.path)
 
-        out[coll_name] = pd.DataFrame(arrays)
+    def done(self, ichunk):
+        chunk = self.state['chunks'].get(str(ichunk))
+        return chunk is not None and os.path.exists(chunk['path'])
 
-    return out
+    def mark_done(self, ichunk, path, nrows):
+        self.state['chunks'][str(ichunk)] = {'path': path, 'rows': nrows}
+        self.save()
+
+    def mark_complete(self, output):
+        self.state.update(output=output, complete=True)
+        self.save()
+
+    @property
+    def complete(self):
+        return self.state['complete'] and self.state['output'] is not None and os.path.exists(self.state['output'])
+
+def convert_collection_resumable(filename, ttree_key, collection, output_name, step_size=None, row_group_size=None, sort_by=None, engine='pandas', state=None):
+    '''Resumable version of the per-collection Parquet conversion. Every chunk (see
+    chunk_ranges) is written to <output_name><tree>_<collection>.parts/ and recorded in the
+    ConversionManifest at <output_name><tree>_<collection>.manifest.json. Once all chunks are
+    there they are merged, in order, into <tree>_<collection>.parquet. A re-run skips a
+    finished unit whose input did not change and only converts the missing chunks of a
+    partial one. state is the input state of filename, computed here if not given.
+    Returns the Parquet file (None if the tree is empty).'''
+    input_file = uproot.open(filename, handler=uproot.MemmapSource)
+    tree, nano = input_file[ttree_key], ttree_key == 'Events'
+    val_names = get_collection_dict(input_file, ttree_key)[collection]
+    coll_sort_by = _for_collection(sort_by, collection)
+    ranges = chunk_ranges(tree, _iterate_branches({collection: val_names}, nano), step_size)
+
+    output = f'{output_name}{ttree_key}_{collection}.parquet'
+    manifest = ConversionManifest(output.replace('.parquet', '.manifest.json'), filename, ttree_key, collection, ranges,
+                                  {'row_group_size': row_group_size, 'sort_by': coll_sort_by, 'engine': engine}, state)
+    if manifest.complete:
+        logging.info(f'{output} is up to date')
+        return output
+
+    parts = output.replace('.parquet', '.parts')
+    if manifest.stale:
+        subprocess.call(['rm','-rf',parts])
+    os.makedirs(parts, exist_ok=True)
+
+    for ichunk, (start, stop) in enumerate(ranges):
+        if manifest.done(ichunk):
+            continue
+        # value-range narrowing is only consistent between chunks if there is a single one
+        data = read_collection_chunk(tree, collection, val_names, nano, start, stop, engine, value_based=len(ranges) == 1)
+        table = sort_arrow_table(data, coll_sort_by) if engine == 'arrow' else pa.Table.from_pandas(sort_by_keys(data, coll_sort_by), preserve_index=False)
+        part = os.path.join(parts, f'{ichunk:06d}.parquet')
+        pq.write_table(table, part+'.tmp', row_group_size=row_group_size, write_statistics=True,
+                       sorting_columns=parquet_sorting_columns(table.column_names, coll_sort_by))
+        os.replace(part+'.tmp', part)
+        manifest.mark_done(ichunk, part, table.num_rows)
+        logging.debug(f'{output}: chunk {ichunk+1}/{len(ranges)} done')
+
+    if not ranges:
+        logging.warning(f'{ttree_key} in {filename} has no entries')
+        return None
+
+    part_files = [manifest.state['chunks'][str(ichunk)]['path'] for ichunk in range(len(ranges))]
+    schema = pq.read_schema(part_files[0])
+    with pq.ParquetWriter(output+'.tmp', schema, write_statistics=True,
+                          sorting_columns=parquet_sorting_columns(schema.names, coll_sort_by)) as writer:
+        for part in part_files:
+            writer.write_table(pq.read_table(part), row_group_size=row_group_size)
+    os.replace(output+'.tmp', output)
+    manifest.mark_complete(output)
+    subprocess.call(['rm','-rf',parts])
+    return output
+
+# fsync is turned off for the load since a failed load is simply redone from the ROOT file. The
+# rollback journal is kept in memory rather than turned off: about as fast, and ROLLBACK stays
+# defined so a failed load leaves an existing database as it was
+SQLITE_BULK_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -1048576, # negative means KiB, so 1 GiB of page cache
+    'temp_store': 'MEMORY',
+    'locking_mode': 'EXCLUSIVE',
+}
+
+def sqlite_type(dtype):
+    if dtype.kind in 'biu':
+        return 'INTEGER'
+    elif dtype.kind == 'f':
+        return 'REAL'
+    elif dtype.kind in 'SU':
+        return 'TEXT'
+    else:
+        return 'BLOB'
+
+def relational_tables(input_file):
+    '''Generator of (table name, DataFrame) for every collection of every TTree in input_file.'''
+    for ttree_key in ttree_keys(input_file):
+        collections = extract_to_collections(input_file, ttree_key, True if ttree_key == 'Events' else False)
+        if collections is None:
+            continue
+
+        for collection, df in collections.items():
+            yield f'{ttree_key}-{collection}', df
+
+def create_sqlite_table(conn, table_name, df, if_not_exists=False):
+    '''Create table_name with a schema typed from the DataFrame dtypes. Tables with keys
+    (see table_keys) are clustered on their primary key (WITHOUT ROWID). Returns the keys.'''
+    schema = ', '.join(f'"{c}" {sqlite_type(df[c].dtype)}' for c in df.columns)
+    keys = table_keys(df.columns)
+    if keys:
+        schema += ', PRIMARY KEY ({})'.format(', '.join(f'"{k}"' for k in keys))
+    conn.execute(f'CREATE TABLE {"IF NOT EXISTS " if if_not_exists else ""}"{table_name}" ({schema}){" WITHOUT ROWID" if keys else ""}')
+    return keys
+
+def bulk_insert_sqlite(conn, table_name, df, batch_size=100000, if_not_exists=False):
+    '''Create table_name (see create_sqlite_table) and fill it with executemany() over
+    slices of the underlying NumPy columns. Rows are inserted in key order.'''
+    keys = create_sqlite_table(conn, table_name, df, if_not_exists)
+    if keys:
+        df = df.sort_values(keys, kind='stable')
+
+    insert = f'INSERT INTO "{table_name}" VALUES ({", ".join(["?"]*len(df.columns))})'
+    arrays = [df[c].to_numpy() for c in df.columns]
+    for start in range(0, len(df), batch_size):
+        conn.executemany(insert, zip(*[a[start:start+batch_size].tolist() for a in arrays]))
+
+    return len(df)
+
+def create_sqlite_indexes(conn, table_names):
+    '''Index event on the tables where it is not the leading primary key column,
+    so that joins on event are index lookups everywhere.'''
+    for table_name in table_names:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+        keys = table_keys(columns)
+        if keys and keys[0] != 'event':
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{table_name}_event" ON "{table_name}" (event)')
+
+def write_sqlite_bulk(output_name, tables):
+    '''Load all (table name, DataFrame) pairs in a single transaction with bulk-load
+    PRAGMAs. Indexes are only built once all of the rows are in. Returns the number of rows.'''
+    conn = sqlite3.connect(output_name, isolation_level=None)
+    for pragma, value in SQLITE_BULK_PRAGMAS.items():
+        conn.execute(f'PRAGMA {pragma}={value}')
+
+    nrows, table_names = 0, []
+    try:
+        conn.execute('BEGIN')
+        for table_name, df in tables:
+            nrows += bulk_insert_sqlite(conn, table_name, df)
+            table_names.append(table_name)
+        create_sqlite_indexes(conn, table_names)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
 
-def make_relational_sql(filename, output_name='', overwrite=False):
+    return nrows
+
+def write_sqlite_resumable(output_name, filename, step_size=None):
+    '''Resumable version of write_sqlite_bulk. Every table is loaded in entry-range chunks
+    (see chunk_ranges), each in its own transaction together with its row in the _manifest
+    table, so the database never holds a chunk that is not recorded as done. _manifest_inputs
+    keeps the input state (see input_state) and chunking per table; a table whose input or
+    chunking changed is dropped and reloaded, finished chunks are skipped. Uses WAL instead of
+    the in-memory journal of the bulk PRAGMAs so that a chunk interrupted even by a crash is
+    rolled back cleanly.
+    Returns the number of rows inserted by this call.'''
+    conn = sqlite3.connect(output_name, isolation_level=None)
+    for pragma, value in dict(SQLITE_BULK_PRAGMAS, journal_mode='WAL', synchronous='NORMAL', locking_mode='NORMAL').items():
+        conn.execute(f'PRAGMA {pragma}={value}')
+    conn.execute('CREATE TABLE IF NOT EXISTS _manifest_inputs (table_name TEXT PRIMARY KEY, input TEXT, ranges TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS _manifest (table_name TEXT, chunk INTEGER, entry_start INTEGER, entry_stop INTEGER, nrows INTEGER, PRIMARY KEY (table_name, chunk))')
+
+    input_file = uproot.open(filename, handler=uproot.MemmapSource)
+    nrows, table_names = 0, []
+    try:
+        row = conn.execute('SELECT input FROM _manifest_inputs LIMIT 1').fetchone()
+        state, _ = input_state(filename, json.loads(row[0]) if row else None)
+        for ttree_key in ttree_keys(input_file):
+            collection_dict = get_collection_dict(input_file, ttree_key)
+            if isinstance(collection_dict, str):
+                continue
+            tree, nano = input_file[ttree_key], ttree_key == 'Events'
+
+            for collection, val_names in collection_dict.items():
+                table_name = f'{ttree_key}-{collection}'
+                ranges = chunk_ranges(tree, _iterate_branches({collection: val_names}, nano), step_size)
+                row = conn.execute('SELECT input, ranges FROM _manifest_inputs WHERE table_name = ?', (table_name,)).fetchone()
+                conn.execute('BEGIN')
+                if input_changed(state, json.loads(row[0]) if row else None) or json.loads(row[1]) != [list(r) for r in ranges]:
+                    conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+                    conn.execute('DELETE FROM _manifest WHERE table_name = ?', (table_name,))
+                conn.execute('INSERT OR REPLACE INTO _manifest_inputs VALUES (?, ?, ?)', (table_name, json.dumps(state), json.dumps(ranges)))
+                conn.execute('COMMIT')
+
+                done = {r[0] for r in conn.execute('SELECT chunk FROM _manifest WHERE table_name = ?', (table_name,))}
+                for ichunk, (start, stop) in enumerate(ranges):
+                    if ichunk in done:
+                        continue
+                    df = read_collection_chunk(tree, collection, val_names, nano, start, stop, value_based=True)
+                    conn.execute('BEGIN')
+                    try:
+                        n = bulk_insert_sqlite(conn, table_name, df, if_not_exists=True)
+                        conn.execute('INSERT INTO _manifest VALUES (?, ?, ?, ?, ?)', (table_name, ichunk, start, stop, n))
+                        conn.execute('COMMIT')
+                    except Exception:
+                        conn.execute('ROLLBACK')
+                        raise
+                    nrows += n
+                table_names.append(table_name)
+
+        create_sqlite_indexes(conn, table_names)
+    finally:
+        conn.close()
+
+    return nrows
+
+def write_sqlite_pandas(output_name, tables):
+    '''Previous loader through DataFrame.to_sql, kept as the reference for bench_sql_load.'''
+    nrows = 0
+    engine = create_engine(f'sqlite:///{output_name}')
+    with engine.connect() as conn, conn.begin():
+        for table_name, df in tables:
+            df.to_sql(table_name, conn, chunksize=1000)
+            nrows += len(df)
+
+    return nrows
+
+def make_relational_sql(filename, output_name='', overwrite=False, method='bulk', resume=False, step_size=None):
+    '''Load every collection of filename into an SQLite database. With resume=True the load
+    is incremental (see write_sqlite_resumable) and step_size sets the chunking.'''
     input_file = uproot.open(filename)
     if not output_name:
         output_name = filename.replace('.root','.db')
 
     if overwrite:
-        subprocess.call(['rm',output_name])
-    
-    engine = create_engine(f'sqlite:///{output_name}')
-    with engine.connect() as conn, conn.begin():
-        for ttree_key in ttree_keys(input_file):
-            collections = extract_to_collections(input_file, ttree_key, True if ttree_key == 'Events' else False)
-            if collections is None:
-                continue
-            
-            for collection, df in collections.items():
-                df.to_sql(f'{ttree_key}-{collection}', engine, chunksize=1000)
+        subprocess.call(['rm','-f',output_name])
 
-def make_relational_parquet(filename, output_name='', overwrite=False):
-    input_file = uproot.open(filename)
+    if resume:
+        return write_sqlite_resumable(output_name, filename, step_size)
+    elif method == 'bulk':
+        return write_sqlite_bulk(output_name, relational_tables(input_file))
+    elif method == 'pandas':
+        return write_sqlite_pandas(output_name, relational_tables(input_file))
+    else:
+        raise ValueError(f'Unknown method "{method}". Must be one of "bulk" or "pandas".')
+
+def bench_sql_load(filename, methods=('pandas', 'bulk')):
+    '''Throughput (rows/sec) of the SQLite loaders on the collections of filename.
+    Extraction from ROOT happens once up front so only the load is timed.'''
+    tables = list(relational_tables(uproot.open(filename)))
+    out = {}
+    for method in methods:
+        output_name = filename.replace('.root', f'_bench_{method}.db')
+        subprocess.call(['rm','-f',output_name])
+        start = time.perf_counter()
+        nrows = {'bulk': write_sqlite_bulk, 'pandas': write_sqlite_pandas}[method](output_name, tables)
+        out[method] = nrows/(time.perf_counter() - start)
+        logging.info(f'{method}: {nrows} rows at {out[method]:.0f} rows/sec')
+        os.remove(output_name)
+
+    return out
+
+def make_relational_parquet(filename, output_name='', overwrite=False, step_size=None, row_group_size=None, sort_by=None, engine='pandas', resume=False):
+    '''Convert the Events tree of filename to one Parquet file per collection.
+    If step_size is given (number of entries or a size string like "100 MB"),
+    the tree is streamed in chunks so that memory use does not grow with the input.
+    Row groups carry min/max statistics; see stream_to_parquet for row_group_size and sort_by.
+    engine='arrow' skips pandas and always streams (the whole tree as one chunk if step_size
+    is None). The ROOT file is memory-mapped so baskets are read from the page cache.
+    resume=True converts each collection with convert_collection_resumable, so an
+    interrupted or repeated conversion only redoes what is missing or changed.'''
+    input_file = uproot.open(filename, handler=uproot.MemmapSource)
     if not output_name:
         output_name = os.path.expanduser(filename.replace('.root','/'))
 
     if overwrite:
         subprocess.call(['rm','-rf',output_name])
     
-    os.mkdir(output_name)
+    os.makedirs(output_name, exist_ok=resume)
 
 
     for ttree_key in ['Events']:#ttree_keys(input_file):
+        if resume:
+            state, _ = input_state(filename, recorded_input(sorted(glob.glob(f'{output_name}{ttree_key}_*.manifest.json'))))
+            for collection in get_collection_dict(input_file, ttree_key):
+                convert_collection_resumable(filename, ttree_key, collection, output_name, step_size, row_group_size, sort_by, engine, state)
+            continue
+
+        if engine == 'arrow':
+            stream_to_parquet(input_file, ttree_key, output_name, step_size or input_file[ttree_key].num_entries,
+                              row_group_size=row_group_size, sort_by=sort_by, engine=engine)
+            continue
+
+        if step_size is not None:
+            stream_to_parquet(input_file, ttree_key, output_name, step_size, row_group_size=row_group_size, sort_by=sort_by)
+            continue
+
         collections = extract_to_collections(input_file, ttree_key, True if ttree_key == 'Events' else False)
         if collections is None:
                 continue
 
         for collection, df in collections.items():
-            df.to_parquet(f'{output_name}{ttree_key}_{collection}.parquet')
+            coll_sort_by = _for_collection(sort_by, collection)
+            df = sort_by_keys(df, coll_sort_by)
+            output = f'{output_name}{ttree_key}_{collection}.parquet'
+            df.to_parquet(output+'.tmp', index=False, row_group_size=row_group_size,
+                          write_statistics=True, sorting_columns=parquet_sorting_columns(df.columns, coll_sort_by))
+            os.replace(output+'.tmp', output)
 
-def read_tgz(filename, tree='Events', collections=None):
-    file = tarfile.open(filename, 'r:gz')
-    out = defaultdict(dict)
-    for subfilename in [n for n in file.getnames() if not n.endswith('/')]:
-        if subfilename == '.':
+def _bench_conversion(filename, engine, step_size):
+    output_name = filename.replace('.root', f'_bench_{engine}/')
+    with StageMonitor() as monitor:
+        make_relational_parquet(filename, output_name, overwrite=True, step_size=step_size, engine=engine)
+    subprocess.call(['rm','-rf',output_name])
+    return monitor.result
+
+def bench_parquet_conversion(filename, engines=('pandas', 'arrow'), step_size=None):
+    '''Wall time and peak RSS of make_relational_parquet for each engine. Every engine runs
+    in a fresh process so the peak memory of one does not hide the other's.'''
+    out = {}
+    for engine in engines:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            out[engine] = pool.submit(_bench_conversion, filename, engine, step_size).result()
+        logging.info(f'{engine}: {out[engine]["wall_s"]:.2f} s, peak RSS {out[engine]["peak_rss_bytes"]/1e6:.0f} MB')
+
+    return out
+
+def _convert_unit(filename, ttree_key, collection, output_name, step_size, row_group_size=None, sort_by=None, resume=False, state=None):
+    if resume:
+        return [convert_collection_resumable(filename, ttree_key, collection, output_name, step_size, row_group_size, sort_by, state=state)]
+    input_file = uproot.open(filename)
+    return stream_to_parquet(input_file, ttree_key, output_name, step_size, [collection], row_group_size, sort_by)
+
+def conversion_units(filenames, trees=None):
+    '''List the (file, tree, collection) units to convert, in a deterministic order.
+    A file or tree that cannot be opened is reported instead of stopping the listing;
+    returns (units, {(file, tree or None, None): error message}).'''
+    units, failed = [], {}
+    for filename in filenames:
+        try:
+            input_file = uproot.open(filename)
+            tree_names = ttree_keys(input_file) if trees is None else trees
+        except Exception as e:
+            logging.error(f'Failed to open {filename}: {e!r}')
+            failed[(filename, None, None)] = repr(e)
             continue
-        tree_name, coll_name = subfilename.split('/')[-1].split('.',1)[0].split('_')
+
+        for ttree_key in tree_names:
+            try:
+                collection_dict = get_collection_dict(input_file, ttree_key)
+            except Exception as e:
+                logging.error(f'Failed to read the layout of {ttree_key} in {filename}: {e!r}')
+                failed[(filename, ttree_key, None)] = repr(e)
+                continue
+            if isinstance(collection_dict, str):
+                logging.warning(f'Skipping {ttree_key} in {filename}: {collection_dict}')
+                continue
+            units.extend((filename, ttree_key, collection) for collection in collection_dict)
+
+    return units, failed
+
+def _file_input_state(filename, prefix):
+    return input_state(filename, recorded_input(sorted(glob.glob(prefix+'*.manifest.json'))))[0]
+
+def pack_relational_zip(folder, output_name):
+    '''Pack the Parquet files of a converted folder into one zip with stored (uncompressed)
+    members. The zip central directory acts as the footer index and every member is a
+    contiguous byte range, so readers can seek to and memory-map a single collection.
+    Parquet pages are already compressed so storing costs nothing in size.'''
+    with zipfile.ZipFile(output_name, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zfile:
+        for subfilename in sorted(glob.glob(os.path.join(folder, '*.parquet'))):
+            zfile.write(subfilename, os.path.basename(subfilename))
+
+    return output_name
+
+def make_relational_zip(filename, output_name='', overwrite=False, step_size=None, row_group_size=None, sort_by=None):
+    '''Same conversion as make_relational_parquet but packaged into a single seekable
+    zip archive (see pack_relational_zip) that can be read with read_zip.'''
+    if not output_name:
+        output_name = os.path.expanduser(filename.replace('.root','.zip'))
+
+    if os.path.exists(output_name) and not overwrite:
+        raise FileExistsError(f'{output_name} already exists. Set overwrite=True to replace it.')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        folder = os.path.join(tmpdir, '')
+        make_relational_parquet(filename, folder, True, step_size, row_group_size, sort_by)
+        return pack_relational_zip(folder, output_name)
+
+def make_relational_parquet_multi(inputs, output_dir, trees=None, workers=None, step_size='100 MB', overwrite=False, row_group_size=None, sort_by=None, resume=False):
+    '''Convert many ROOT files in a process pool, one task per (file, tree, collection).
+    inputs is a glob pattern or a list of files. Outputs are written to
+    <output_dir>/<file stem>/<tree>_<collection>.parquet. A failing unit (or an unreadable
+    file, reported as (file, None, None)) does not stop the others; returns
+    ({unit: files written}, {unit: error message}).
+    With resume=True units go through convert_collection_resumable, so re-running over a
+    growing dataset only converts new or changed files and unfinished chunks. The input
+    state of every file is computed once, in the pool, and shared by its units.'''
+    filenames = sorted(glob.glob(os.path.expanduser(inputs))) if isinstance(inputs, str) else list(inputs)
+    output_dir = os.path.expanduser(output_dir)
+    if overwrite:
+        subprocess.call(['rm','-rf',output_dir])
+
+    prefixes = {filename: os.path.join(output_dir, os.path.basename(filename).replace('.root',''), '') for filename in filenames}
+    for prefix in prefixes.values():
+        os.makedirs(prefix, exist_ok=True)
+
+    done = {}
+    units, failed = conversion_units(filenames, trees)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        states = {}
+        if resume:
+            state_futures = {pool.submit(_file_input_state, f, prefixes[f]): f for f in sorted({filename for filename, _, _ in units})}
+            for future in as_completed(state_futures):
+                filename = state_futures[future]
+                try:
+                    states[filename] = future.result()
+                except Exception as e:
+                    logging.error(f'Failed to read the input state of {filename}: {e!r}')
+                    failed[(filename, None, None)] = repr(e)
+            units = [unit for unit in units if unit[0] in states]
+        futures = {
+            pool.submit(_convert_unit, filename, ttree_key, collection, prefixes[filename], step_size, row_group_size, sort_by, resume, states.get(filename)): (filename, ttree_key, collection)
+            for filename, ttree_key, collection in units
+        }
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            unit = futures[future]
+            try:
+                done[unit] = future.result()
+            except Exception as e:
+                logging.error(f'Failed to convert {unit}: {e!r}')
+                failed[unit] = repr(e)
+
+    if trees is None or 'Events' in trees:
+        write_dataset_metadata(output_dir)
+    return done, failed
+
+def parse_member_name(name):
+    '''(tree, collection) from a <tree>_<collection>.parquet file name.'''
+    return tuple(name.split('/')[-1].split('.',1)[0].split('_',1))
+
+FILTER_OPS = {
+    '=': operator.eq, '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+}
+
+def normalize_filters(filters):
+    '''Filters follow the pyarrow/dask convention: a list of (column, op, value) tuples
+    that are ANDed together, or a list of such lists that are ORed. Returns the latter form.'''
+    if not filters:
+        return []
+    elif isinstance(filters[0], tuple):
+        return [list(filters)]
+    else:
+        return [list(conjunction) for conjunction in filters]
+
+def filter_columns(filters):
+    return sorted(set(column for conjunction in normalize_filters(filters) for column, op, value in conjunction))
+
+def _term_may_match(low, high, op, value):
+    if op in ('=', '=='):
+        return low <= value <= high
+    elif op == '!=':
+        return not (low == high == value)
+    elif op == '<':
+        return low < value
+    elif op == '<=':
+        return low <= value
+    elif op == '>':
+        return high > value
+    elif op == '>=':
+        return high >= value
+    elif op == 'in':
+        return any(low <= v <= high for v in value)
+    elif op == 'not in':
+        return not (low == high and low in value)
+    else:
+        raise ValueError(f'Unknown filter operator "{op}".')
+
+def row_group_may_match(row_group, filters):
+    '''False only if the min/max statistics of the row group (pq.RowGroupMetaData)
+    prove that none of its rows pass the filters.'''
+    stats = {}
+    for icol in range(row_group.num_columns):
+        column = row_group.column(icol)
+        if column.is_stats_set and column.statistics.has_min_max:
+            stats[column.path_in_schema] = (column.statistics.min, column.statistics.max)
+
+    return any(
+        all(column not in stats or _term_may_match(*stats[column], op, value) for column, op, value in conjunction)
+        for conjunction in normalize_filters(filters)
+    )
+
+def matching_row_groups(pfile, filters, row_groups=None):
+    '''Indices of the row groups of pfile (pq.ParquetFile) that may contain rows passing the filters.'''
+    row_groups = range(pfile.num_row_groups) if row_groups is None else row_groups
+    if not filters:
+        return list(row_groups)
+    return [irg for irg in row_groups if row_group_may_match(pfile.metadata.row_group(irg), filters)]
+
+def apply_filters(df, filters):
+    '''Exact row-level evaluation of the filters.'''
+    if not filters:
+        return df
+
+    mask = np.zeros(len(df), dtype=bool)
+    for conjunction in normalize_filters(filters):
+        conjunction_mask = np.ones(len(df), dtype=bool)
+        for column, op, value in conjunction:
+            if op == 'in':
+                conjunction_mask &= df[column].isin(value).to_numpy()
+            elif op == 'not in':
+                conjunction_mask &= ~df[column].isin(value).to_numpy()
+            else:
+                conjunction_mask &= FILTER_OPS[op](df[column], value).to_numpy()
+        mask |= conjunction_mask
+
+    return df[mask].reset_index(drop=True)
+
+def _with_filter_columns(columns, filters):
+    if columns is None or not filters:
+        return columns
+    return list(columns) + [c for c in filter_columns(filters) if c not in columns]
+
+class RelationalArchive():
+    '''Lazy reader over the per-collection Parquet files of one archive. The members
+    are indexed once when opened and each Parquet file is only opened (footer read)
+    on first use. Reads can be limited to a set of columns and of row groups, and
+    filters (see normalize_filters) skip the row groups whose statistics cannot match.
+    Use it as a context manager (or call close) to release the underlying file.'''
+    def __init__(self, filename) -> None:
+        self.filename = filename
+        self.members = self._index_members()
+        self._parquet_files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self._parquet_files.clear()
+
+    def _index_members(self):
+        '''Return {(tree, collection): member}.'''
+        raise NotImplementedError()
+
+    def _open_member(self, member):
+        '''Return a seekable file object for the member.'''
+        raise NotImplementedError()
+
+    def collections(self, tree='Events'):
+        return [coll_name for tree_name, coll_name in self.members if tree_name == tree]
+
+    def parquet_file(self, tree, collection):
+        if (tree, collection) not in self._parquet_files:
+            self._parquet_files[(tree, collection)] = pq.ParquetFile(self._open_member(self.members[(tree, collection)]))
+        return self._parquet_files[(tree, collection)]
+
+    def read(self, tree, collection, columns=None, row_groups=None, filters=None):
+        pfile = self.parquet_file(tree, collection)
+        if filters:
+            row_groups = matching_row_groups(pfile, filters, row_groups)
+            logging.debug(f'{tree}_{collection}: reading {len(row_groups)}/{pfile.num_row_groups} row groups')
+
+        read_columns = _with_filter_columns(columns, filters)
+        if row_groups is None:
+            table = pfile.read(columns=read_columns)
+        else:
+            table = pfile.read_row_groups(row_groups, columns=read_columns)
+
+        df = apply_filters(table.to_pandas(), filters)
+        return df if columns is None else df[list(columns)]
+
+    def iter_row_groups(self, tree, collection, columns=None, filters=None):
+        pfile = self.parquet_file(tree, collection)
+        for irg in matching_row_groups(pfile, filters):
+            df = apply_filters(pfile.read_row_group(irg, columns=_with_filter_columns(columns, filters)).to_pandas(), filters)
+            yield df if columns is None else df[list(columns)]
+
+class LazyTgz(RelationalArchive):
+    '''RelationalArchive over a gzipped tarball. Members are read through the tarfile
+    without being copied to memory first, but gzip cannot seek so reaching a member
+    still decompresses everything before it.'''
+    def _index_members(self):
+        self.tarfile = tarfile.open(self.filename, 'r:gz')
+        return {
+            parse_member_name(m.name): m for m in self.tarfile.getmembers()
+            if m.isfile() and m.name.endswith('.parquet')
+        }
+
+    def _open_member(self, member):
+        return self.tarfile.extractfile(member)
+
+    def close(self):
+        super().close()
+        self.tarfile.close()
+
+class LazyZip(RelationalArchive):
+    '''RelationalArchive over a zip of stored members (see pack_relational_zip).
+    The central directory gives the member offsets and each member is handed to
+    pyarrow as a zero-copy slice of the memory-mapped archive.'''
+    def _index_members(self):
+        with zipfile.ZipFile(self.filename) as zfile:
+            infos = [i for i in zfile.infolist() if i.filename.endswith('.parquet')]
+
+        for info in infos:
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'Member {info.filename} of {self.filename} is compressed and cannot be memory-mapped.')
+
+        with open(self.filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return {parse_member_name(i.filename): i for i in infos}
+
+    def _open_member(self, member):
+        # Data starts after the 30 byte local header plus its (variable length) name and extra fields
+        name_len, extra_len = struct.unpack('<HH', self.mmap[member.header_offset+26:member.header_offset+30])
+        start = member.header_offset + 30 + name_len + extra_len
+        return pa.BufferReader(pa.py_buffer(memoryview(self.mmap)[start:start+member.file_size]))
+
+    def close(self):
+        super().close()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Arrow data read zero-copy still points into the map; it is unmapped once that is freed
+            logging.debug(f'{self.filename} is still referenced, leaving it mapped')
+
+def _for_collection(option, coll_name):
+    '''Per-collection options (columns, filters, sort_by) are either None, a value
+    applied to every collection, or {collection: value}.'''
+    if isinstance(option, dict):
+        return option.get(coll_name)
+    return option
+
+def _read_archive(archive, tree='Events', collections=None, columns=None, filters=None):
+    out = defaultdict(dict)
+    for tree_name, coll_name in archive.members:
         if (collections is None) or (coll_name in collections and tree_name == tree):
-            subfile = file.extractfile(subfilename)
-            out[tree_name][coll_name] = pd.read_parquet(io.BytesIO(subfile.read()))
+            out[tree_name][coll_name] = archive.read(tree_name, coll_name, _for_collection(columns, coll_name),
+                                                     filters=_for_collection(filters, coll_name))
 
     return out
 
-def read_folder(folder, tree='Events', collections=None):
+def read_tgz(filename, tree='Events', collections=None, columns=None, filters=None):
+    with LazyTgz(filename) as archive:
+        return _read_archive(archive, tree, collections, columns, filters)
+
+def read_zip(filename, tree='Events', collections=None, columns=None, filters=None):
+    with LazyZip(filename) as archive:
+        return _read_archive(archive, tree, collections, columns, filters)
+
+def _filters_to_sql(filters):
+    '''WHERE clause and its parameters for filters (see normalize_filters).'''
+    clauses, params = [], []
+    for conjunction in normalize_filters(filters):
+        terms = []
+        for column, op, value in conjunction:
+            if op in ('in', 'not in'):
+                terms.append(f'"{column}" {op.upper()} ({", ".join(["?"]*len(value))})')
+                params.extend(v.item() if hasattr(v, 'item') else v for v in value)
+            else:
+                terms.append(f'"{column}" {"=" if op == "==" else op} ?')
+                params.append(value.item() if hasattr(value, 'item') else value)
+        clauses.append('(' + ' AND '.join(terms) + ')')
+
+    return (' WHERE ' + ' OR '.join(clauses) if clauses else ''), params
+
+def read_sql(filename, tree='Events', collections=None, columns=None, filters=None):
+    '''Same as read_tgz but for the SQLite output of make_relational_sql. Filters are
+    translated to a WHERE clause so that they can use the table keys.'''
+    conn = sqlite3.connect(filename)
     out = defaultdict(dict)
-    for subfilename in [n for n in glob.glob(folder)]:
+    try:
+        # the <tree>-<collection> naming leaves out the _manifest tables of resumable loads
+        table_names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '%-%'")]
+        for table_name in table_names:
+            tree_name, coll_name = table_name.split('-', 1)
+            if (collections is None) or (coll_name in collections and tree_name == tree):
+                coll_columns = _for_collection(columns, coll_name)
+                where, params = _filters_to_sql(_for_collection(filters, coll_name))
+                select = '*' if coll_columns is None else ', '.join(f'"{c}"' for c in coll_columns)
+                out[tree_name][coll_name] = pd.read_sql_query(f'SELECT {select} FROM "{table_name}"{where}', conn, params=params)
+    finally:
+        conn.close()
+
+    return out
+
+def read_folder(folder, tree='Events', collections=None, columns=None, filters=None):
+    '''One dask DataFrame per collection from the Parquet files matching the folder glob.
+    Files of the same collection (eg. from make_relational_parquet_multi) are read together,
+    and files whose row group statistics cannot match the filters are skipped entirely.
+    A directory rather than a glob is opened as a dataset (see read_dataset).'''
+    if os.path.isdir(os.path.expanduser(folder)):
+        return read_dataset(folder, tree, collections, columns, filters)
+
+    subfilenames = defaultdict(list)
+    for subfilename in sorted(glob.glob(folder)):
         logging.debug(subfilename)
-        tree_name, coll_name = subfilename.split('/')[-1].split('.',1)[0].split('_')
+        tree_name, coll_name = parse_member_name(subfilename)
         if (collections is None) or (coll_name in collections and tree_name == tree):
-            logging.debug(f'{tree_name} {coll_name}')
-            out[tree_name][coll_name] = dd.dataframe.read_parquet('file://'+subfilename)
+            subfilenames[(tree_name, coll_name)].append(subfilename)
+
+    out = defaultdict(dict)
+    for (tree_name, coll_name), coll_files in subfilenames.items():
+        coll_columns, coll_filters = _for_collection(columns, coll_name), _for_collection(filters, coll_name)
+        kept = [f for f in coll_files if matching_row_groups(pq.ParquetFile(f), coll_filters)]
+        logging.debug(f'{tree_name} {coll_name}: reading {len(kept)}/{len(coll_files)} files')
+        if kept:
+            df = dd.dataframe.read_parquet(['file://'+f for f in kept], columns=_with_filter_columns(coll_columns, coll_filters),
+                                           filters=normalize_filters(coll_filters) or None)
+        else:
+            df = dd.dataframe.from_pandas(pq.read_schema(coll_files[0]).empty_table().to_pandas(), npartitions=1)
+
+        out[tree_name][coll_name] = df if coll_columns is None else df[list(coll_columns)]
     
     return out
 
-def run_bench1(filename):
+class Histogram():
+    '''Regularly binned 1D histogram that is filled incrementally (eg. one chunk or row
+    group at a time) so that only the bin counts are kept, never the values.
+
+    With range=(low, high) the binning is fixed and values outside of it go to the
+    underflow/overflow counts. Without range, the range grows in steps of the bin width
+    to cover every fill, up to max_bins bins (growing downwards first); values beyond that
+    go to underflow/overflow too, so a stray value cannot blow up the memory. The width is
+    either given or picked from the first fill (a "nice" value giving about `bins` bins).
+    Histograms with the same bin width can be merged, eg. to combine the ones filled in
+    separate processes, so set width (or range) when filling in parallel.'''
+    def __init__(self, bins=50, range=None, width=None, max_bins=10000) -> None:
+        self.bins = bins
+        self.max_bins = max_bins
+        self.fixed = range is not None
+        self.low, self.width = (range[0], (range[1]-range[0])/bins) if self.fixed else (None, width)
+        self.counts = np.zeros(bins if self.fixed else 0)
+        self.underflow, self.overflow = 0., 0.
+
+    @staticmethod
+    def _nice_width(raw):
+        if raw <= 0 or not np.isfinite(raw):
+            return 1.
+        magnitude = 10**np.floor(np.log10(raw))
+        return magnitude*min(m for m in (1, 2, 5, 10) if m*magnitude >= raw)
+
+    @property
+    def edges(self):
+        if self.low is None:
+            return np.array([])
+        return self.low + self.width*np.arange(len(self.counts)+1)
+
+    @property
+    def centers(self):
+        return self.edges[:-1] + self.width/2
+
+    def _extend(self, vmin, vmax, values, weights):
+        '''Grow the bins to cover [vmin, vmax]. If that takes more than max_bins, the window
+        of max_bins kept is the one around the weighted median of values (it always keeps the
+        current bins).'''
+        if self.width is None:
+            self.width = self._nice_width((vmax - vmin)/self.bins)
+        ref = np.floor(vmin/self.width)*self.width if self.low is None else self.low
+        n = len(self.counts)
+        # bin indices relative to ref, the current bins are [0, n)
+        start = min(int(np.floor((vmin - ref)/self.width)), 0)
+        stop = max(int(np.floor((vmax - ref)/self.width)) + 1, n)
+        size = max(self.max_bins, n)
+        if stop - start > size:
+            order = np.argsort(values)
+            cum = np.cumsum(weights[order])
+            median = values[order][min(np.searchsorted(cum, cum[-1]/2), len(cum)-1)]
+            start = min(max(int(np.floor((median - ref)/self.width)) - size//2, start), stop - size)
+            if n:
+                start = min(max(start, n - size), 0)
+            stop = start + size
+        counts = np.zeros(stop - start)
+        counts[-start:n-start] = self.counts
+        self.low, self.counts = ref + start*self.width, counts
+
+    def fill(self, values, weights=None):
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        finite = np.isfinite(values)
+        values, weights = values[finite], weights[finite]
+        if len(values) == 0:
+            return self
+
+        if not self.fixed:
+            self._extend(values.min(), values.max(), values, weights)
+
+        pos = (values - self.low)/self.width
+        idx = np.floor(pos).astype(np.int64)
+        if not self.fixed: # the range covers the values up to max_bins, so only rounding at its edges can miss
+            idx[(idx == -1) & (pos > -1e-9)] = 0
+            idx[(idx == len(self.counts)) & (pos < len(self.counts) + 1e-9)] = len(self.counts) - 1
+        self.underflow += weights[idx < 0].sum()
+        self.overflow += weights[idx >= len(self.counts)].sum()
+        inside = (idx >= 0) & (idx < len(self.counts))
+        idx, weights = idx[inside], weights[inside]
+
+        self.counts += np.bincount(idx, weights=weights, minlength=len(self.counts))
+        return self
+
+    def merge(self, other):
+        '''Add the counts of other (same bin width and aligned edges) into this histogram.'''
+        if other.low is None:
+            return self
+        if self.low is None and not self.fixed and (self.width is None or np.isclose(self.width, other.width)):
+            self.low, self.width, self.counts = other.low, other.width, other.counts.copy()
+            self.underflow, self.overflow = other.underflow, other.overflow
+            return self
+        if not np.isclose(self.width, other.width) or not np.isclose(((other.low - self.low)/self.width) % 1, 0, atol=1e-6):
+            raise ValueError('Cannot merge histograms with different binning.')
+        if self.fixed and (not np.isclose(self.low, other.low) or len(self.counts) != len(other.counts)):
+            raise ValueError('Cannot merge histograms with different binning.')
+
+        if not self.fixed:
+            self._extend(other.low, other.edges[-1] - self.width/2, other.centers, other.counts)
+        pos = int(round((other.low - self.low)/self.width)) + np.arange(len(other.counts))
+        inside = (pos >= 0) & (pos < len(self.counts))
+        self.counts[pos[inside]] += other.counts[inside]
+        self.underflow += other.underflow + other.counts[pos < 0].sum()
+        self.overflow += other.overflow + other.counts[pos >= len(self.counts)].sum()
+        return self
+
+    def __add__(self, other):
+        return copy.deepcopy(self).merge(other)
+
+    def to_frame(self):
+        edges = self.edges
+        return pd.DataFrame({'low': edges[:-1], 'high': edges[1:], 'center': self.centers, 'count': self.counts})
+
+def merge_histograms(hists):
+    return reduce(lambda x,y: x+y, hists)
+
+def histogram_figure(hist, xlabel):
+    '''Bar chart of the bin counts. Only len(counts) points go into the figure.'''
+    fig = px.bar(hist.to_frame(), x='center', y='count', labels={'center': xlabel})
+    fig.update_traces(width=hist.width)
+    fig.update_layout(bargap=0)
+    return fig
+
+def select_bench1(dfs):
+    return {'fig1': dfs['event'].MET_sumEt}
+
+def run_bench1(filename, output_dir='test_images'):
     '''Plot the MET (missing transverse energy) of all events.'''
-    dfs = read_tgz(filename,collections=['event'])
-    fig = px.histogram(dfs['Events']['event'], 'MET_sumEt')
-    fig.write_image("test_images/fig1.pdf")
+    write_query_figures(1, run_query(1, filename, QUERY_CACHE), output_dir)
+
+def select_bench2(dfs):
+    return {'fig2': dfs['Jet'].pt}
 
-def run_bench2(filename):
+def run_bench2(filename, output_dir='test_images'):
     '''Plot the pT (transverse momentum) of all jets in all events.'''
-    dfs = read_tgz(filename,collections=['Jet'])
-    fig = px.histogram(dfs['Events']['Jet'], 'pt')
-    fig.write_image("test_images/fig2.pdf")
+    write_query_figures(2, run_query(2, filename, QUERY_CACHE), output_dir)
 
-def run_bench3(filename):
-    '''Plot the pT of jets with |eta| < 1 (jet pseudorapidity).'''
-    dfs = read_tgz(filename,collections=['Jet'])
-    jets = dfs['Events']['Jet']
-    jets = jets[abs(jets.eta) < 1.0]
-    fig = px.histogram(jets, 'pt')
-    fig.write_image("test_images/fig3.pdf")
+def select_bench3(dfs):
+    jets = dfs['Jet']
+    return {'fig3': jets.pt[abs(jets.eta) < 1.0]}
 
-def run_bench4(filename):
-    '''Plot the MET of the events that have at least two jets with pT > 40 GeV.'''
-    dfs = read_tgz(filename,collections=['event','Jet'])
-    jets = dfs['Events']['Jet']
-    events = dfs['Events']['event']
+def run_bench3(filename, output_dir='test_images'):
+    '''Plot the pT of jets with |eta| < 1 (jet pseudorapidity).'''
+    write_query_figures(3, run_query(3, filename, QUERY_CACHE), output_dir)
 
-    events_w_jets = jets.groupby('event').filter(lambda j: sum(j.pt > 40) > 1).event.unique()
-    events = events[events.event.isin(events_w_jets)]
+def select_bench4(dfs):
+    events = dfs['event']
+    jets = EventReduction(events, dfs['Jet'])
+    return {'fig4': events.MET_sumEt[jets.count(lambda j: j.pt > 40) > 1]}
 
-    fig = px.histogram(events, 'MET_sumEt')
-    fig.write_image("test_images/fig4.pdf")
+def run_bench4(filename, output_dir='test_images'):
+    '''Plot the MET of the events that have at least two jets with pT > 40 GeV.'''
+    write_query_figures(4, run_query(4, filename, QUERY_CACHE), output_dir)
 
 def LVector(*pargs):
     if len(pargs) == 0:
@@ -214,88 +1328,1075 @@ def InvariantMass(*plist):
 def extract_rows(df, *idxs):
     return [df.loc[idx,:] for idx in idxs]
 
-def run_bench5(filename):
+class LVectorArray():
+    '''Batch of Lorentz vectors stored as Cartesian (px, py, pz, E) float64 NumPy arrays.
+    Batched counterpart of LVector: every operation acts on whole columns at once.'''
+    def __init__(self, px, py, pz, e) -> None:
+        self.px, self.py, self.pz, self.e = px, py, pz, e
+
+    @classmethod
+    def from_ptetaphim(cls, pt, eta, phi, mass):
+        pt, eta, phi, mass = [np.asarray(a, dtype=np.float64) for a in (pt, eta, phi, mass)]
+        return cls(pt*np.cos(phi), pt*np.sin(phi), pt*np.sinh(eta), np.hypot(pt*np.cosh(eta), mass))
+
+    @classmethod
+    def from_df(cls, df, prefix=''):
+        '''From the {prefix}pt, {prefix}eta, {prefix}phi and {prefix}mass columns of df.'''
+        return cls.from_ptetaphim(*[df[f'{prefix}{c}'].to_numpy() for c in ['pt','eta','phi','mass']])
+
+    def __len__(self):
+        return len(self.px)
+
+    def __getitem__(self, idx):
+        return LVectorArray(self.px[idx], self.py[idx], self.pz[idx], self.e[idx])
+
+    def __add__(self, other):
+        return LVectorArray(self.px+other.px, self.py+other.py, self.pz+other.pz, self.e+other.e)
+
+    @property
+    def pt(self):
+        return np.hypot(self.px, self.py)
+
+    @property
+    def eta(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.arcsinh(self.pz/self.pt)
+
+    @property
+    def phi(self):
+        return np.arctan2(self.py, self.px)
+
+    @property
+    def mass(self):
+        return np.sqrt(np.maximum(self.e**2 - self.px**2 - self.py**2 - self.pz**2, 0))
+
+    @property
+    def mt(self):
+        '''Transverse mass of each vector on its own, sqrt(pt^2 + m^2).'''
+        return np.sqrt(np.maximum(self.e**2 - self.pz**2, 0))
+
+    def sum_combinations(self, idxs):
+        '''Summed vector of every row of idxs (shape (ncombinations, k)), eg. from combination_indices.'''
+        return LVectorArray(*[c[idxs].sum(axis=1) for c in (self.px, self.py, self.pz, self.e)])
+
+    def segment_sum(self, offsets):
+        '''Summed vector of rows offsets[i]:offsets[i+1] for every segment (event). Empty segments give zero.'''
+        def _sum(c):
+            cumulative = np.r_[0, np.cumsum(c)]
+            return cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+        return LVectorArray(*[_sum(c) for c in (self.px, self.py, self.pz, self.e)])
+
+    def delta_r(self, other):
+        dphi = (self.phi - other.phi + np.pi) % (2*np.pi) - np.pi
+        return np.hypot(self.eta - other.eta, dphi)
+
+    def transverse_mass(self, other):
+        '''Transverse mass of the two-body system of self and other (eg. a lepton and the MET).'''
+        px, py = self.px + other.px, self.py + other.py
+        return np.sqrt(np.maximum((self.mt + other.mt)**2 - px**2 - py**2, 0))
+
+def bench_lvector_array(n=10**6, n_scalar=2000, seed=0):
+    '''Micro-benchmark of LVectorArray against the scalar LVector/InvariantMass path
+    on random pairs. Returns the time per pair in ns for each operation and backend.'''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'pt': rng.exponential(30, n)+5, 'eta': rng.uniform(-2.5, 2.5, n),
+                       'phi': rng.uniform(-np.pi, np.pi, n), 'mass': rng.exponential(5, n)})
+    first, second = rng.integers(0, n, n), rng.integers(0, n, n)
+    out = {}
+
+    start = time.perf_counter()
+    for i, j in zip(first[:n_scalar], second[:n_scalar]):
+        InvariantMass(df.iloc[i], df.iloc[j])
+    out['mass_scalar'] = 1e9*(time.perf_counter() - start)/n_scalar
+
+    start = time.perf_counter()
+    for i, j in zip(first[:n_scalar], second[:n_scalar]):
+        LVector(df.iloc[i]).deltaR(LVector(df.iloc[j]))
+    out['delta_r_scalar'] = 1e9*(time.perf_counter() - start)/n_scalar
+
+    start = time.perf_counter()
+    vectors = LVectorArray.from_df(df)
+    (vectors[first] + vectors[second]).mass
+    out['mass_batched'] = 1e9*(time.perf_counter() - start)/n
+
+    start = time.perf_counter()
+    vectors = LVectorArray.from_df(df)
+    vectors[first].delta_r(vectors[second])
+    out['delta_r_batched'] = 1e9*(time.perf_counter() - start)/n
+
+    for op in ['mass', 'delta_r']:
+        logging.info(f'{op}: scalar {out[op+"_scalar"]:.0f} ns/pair, batched {out[op+"_batched"]:.1f} ns/pair '
+                     f'({out[op+"_scalar"]/out[op+"_batched"]:.0f}x)')
+
+    return out
+
+def event_offsets(event_column):
+    '''For a table sorted by event, return the unique events and the offsets such that
+    the objects of events[i] are rows offsets[i]:offsets[i+1].'''
+    event_column = np.asarray(event_column)
+    starts = np.flatnonzero(np.r_[True, event_column[1:] != event_column[:-1]]) if len(event_column) else np.array([], dtype=np.int64)
+    return event_column[starts], np.r_[starts, len(event_column)].astype(np.int64)
+
+def ensure_event_sorted(df):
+    if not df.event.is_monotonic_increasing:
+        df = sort_by_keys(df)
+    return df
+
+def combination_indices(offsets, k):
+    '''All k-combinations of rows (in increasing row order) inside every event.
+    Returns the event index (into the offsets) of each combination and an
+    (ncombinations, k) array of row indices, ordered by event. Only loops over
+    the distinct object multiplicities, not the events.'''
+    counts = np.diff(offsets)
+    ievent, idxs = [], []
+    for n in np.unique(counts[counts >= k]):
+        selected = np.flatnonzero(counts == n)
+        local = np.array(list(itertools.combinations(range(n), k)), dtype=np.int64)
+        ievent.append(np.repeat(selected, len(local)))
+        idxs.append((offsets[selected][:, None, None] + local[None, :, :]).reshape(-1, k))
+
+    if not ievent:
+        return np.array([], dtype=np.int64), np.empty((0, k), dtype=np.int64)
+
+    ievent, idxs = np.concatenate(ievent), np.concatenate(idxs)
+    order = np.argsort(ievent, kind='stable')
+    return ievent[order], idxs[order]
+
+def pair_indices(offsets):
+    '''All (i, j) row pairs with i < j inside every event, as (event index, i, j).'''
+    ievent, idxs = combination_indices(offsets, 2)
+    return ievent, idxs[:, 0], idxs[:, 1]
+
+def pair_invariant_mass(df, first, second):
+    '''Invariant mass of the (first, second) row pairs of a pt/eta/phi/mass table.'''
+    vectors = LVectorArray.from_df(df)
+    return (vectors[first] + vectors[second]).mass
+
+def segment_argmin(values, segment):
+    '''For values grouped by a sorted segment id, return the segment ids and the
+    index (into values) of the minimum of each segment. Ties go to the first one.'''
+    order = np.lexsort((values, segment))
+    first = np.r_[True, segment[order][1:] != segment[order][:-1]] if len(order) else np.array([], dtype=bool)
+    return segment[order][first], order[first]
+
+def segment_argmax(values, segment):
+    return segment_argmin(-values, segment)
+
+def best_combinations(objects, k, target_mass):
+    '''Per event, the k-combination of objects with invariant mass closest to target_mass.
+    Events with fewer than k objects are dropped. Returns the event numbers, the
+    (nevents, k) row indices into the event-sorted objects and the summed LVectorArray.'''
+    events, offsets = event_offsets(objects.event.to_numpy())
+    ievent, idxs = combination_indices(offsets, k)
+    systems = LVectorArray.from_df(objects).sum_combinations(idxs)
+    best_ievent, best = segment_argmin(np.abs(systems.mass - target_mass), ievent)
+    return events[best_ievent], idxs[best], systems[best]
+
+def best_trijets(jets, target_mass=172.5):
+    '''Trijet with mass closest to target_mass in each event with at least three jets.
+    Returns a DataFrame with the event, trijet pt and mass, and the maximum btagDeepB of its jets.'''
+    jets = ensure_event_sorted(jets)
+    events, idxs, trijets = best_combinations(jets, 3, target_mass)
+    return pd.DataFrame({
+        'event': events,
+        'pt': trijets.pt,
+        'mass': trijets.mass,
+        'btagDeepB': jets.btagDeepB.to_numpy()[idxs].max(axis=1),
+    })
+
+def opposite_charge_pair_events(objects, mass_low=60, mass_high=120):
+    '''Events (numbers) with an opposite-charge pair of objects with mass_low < M < mass_high.'''
+    objects = ensure_event_sorted(objects)
+    events, offsets = event_offsets(objects.event.to_numpy())
+    ievent, first, second = pair_indices(offsets)
+    charge = objects.charge.to_numpy()
+    M = pair_invariant_mass(objects, first, second)
+    passing = (charge[first] != charge[second]) & (M > mass_low) & (M < mass_high)
+    return np.unique(events[ievent[passing]])
+
+def aligned_segments(event_column, events):
+    '''Start row and number of rows of each of the (sorted) events in an event-sorted column.
+    Events without any rows get a count of zero.'''
+    starts = np.searchsorted(event_column, events, 'left')
+    return starts, np.searchsorted(event_column, events, 'right') - starts
+
+class EventReduction():
+    '''Per-event reductions (count, any, all, sum, max, min) of an object table, aligned
+    to the rows of an event table so that the results can be used directly as masks on it.
+    The segments of every event are found once from the sorted event keys and each
+    reduction is then a single vectorized pass over the objects.
+
+    Values and masks can be given as a column name, a callable taking self.objects or
+    an array aligned to self.objects (the event-sorted copy of the objects).'''
+    def __init__(self, events, objects) -> None:
+        self.objects = ensure_event_sorted(objects)
+        event_keys = events.event.to_numpy()
+        order = np.argsort(event_keys, kind='stable')
+        starts, counts = aligned_segments(self.objects.event.to_numpy(), event_keys[order])
+        # back to the row order of the event table
+        self.starts, self.counts = np.empty_like(starts), np.empty_like(counts)
+        self.starts[order], self.counts[order] = starts, counts
+
+    def _values(self, values):
+        if isinstance(values, str):
+            values = self.objects[values]
+        elif callable(values):
+            values = values(self.objects)
+        return np.asarray(values)
+
+    def sum(self, values, mask=None):
+        values = self._values(values)
+        values = values.astype(np.float64 if values.dtype.kind == 'f' else np.int64)
+        if mask is not None:
+            values = np.where(self._values(mask), values, 0)
+        cumulative = np.r_[0, np.cumsum(values)]
+        return cumulative[self.starts + self.counts] - cumulative[self.starts]
+
+    def count(self, mask=None):
+        if mask is None:
+            return self.counts.copy()
+        return self.sum(self._values(mask).astype(np.int64))
+
+    def any(self, mask):
+        return self.count(mask) > 0
+
+    def all(self, mask):
+        return self.count(mask) == self.counts
+
+    def max(self, values, mask=None, fill=np.nan):
+        '''Maximum per event. Events without (selected) objects get fill.'''
+        values = self._values(values).astype(np.float64)
+        if mask is not None:
+            values = np.where(self._values(mask), values, -np.inf)
+        out = np.full(len(self.counts), -np.inf)
+        nonempty = self.counts > 0
+        if nonempty.any():
+            # reduceat over interleaved (start, stop) pairs; the padding makes the last stop a valid index
+            bounds = np.ravel(np.c_[self.starts[nonempty], self.starts[nonempty] + self.counts[nonempty]])
+            out[nonempty] = np.maximum.reduceat(np.r_[values, -np.inf], bounds)[::2]
+        return np.where(np.isneginf(out), fill, out)
+
+    def min(self, values, mask=None, fill=np.nan):
+        return -self.max(-self._values(values).astype(np.float64), mask, -fill)
+
+def cross_pair_indices(starts_a, counts_a, starts_b, counts_b):
+    '''All (a, b) row pairs between two collections inside every event, where the
+    segments of both collections are aligned to the same events (see aligned_segments).
+    Returns the event index of each pair plus the row indices into a and into b.'''
+    npairs = counts_a*counts_b
+    ievent = np.repeat(np.arange(len(npairs)), npairs)
+    local = np.arange(npairs.sum()) - np.repeat(np.cumsum(npairs) - npairs, npairs)
+    counts_b = counts_b[ievent]
+    return ievent, starts_a[ievent] + local // counts_b, starts_b[ievent] + local % counts_b
+
+def any_within_delta_r(a, b, max_delta_r):
+    '''Boolean per row of a: whether any row of b in the same event is within max_delta_r.
+    Both tables need to be sorted by event (see ensure_event_sorted).'''
+    events, offsets = event_offsets(a.event.to_numpy())
+    starts_b, counts_b = aligned_segments(b.event.to_numpy(), events)
+    ievent, ia, ib = cross_pair_indices(offsets[:-1], np.diff(offsets), starts_b, counts_b)
+    close = LVectorArray.from_df(a)[ia].delta_r(LVectorArray.from_df(b)[ib]) < max_delta_r
+    return np.bincount(ia[close], minlength=len(a)) > 0
+
+def merge_collections(collections, columns=('event','pt','eta','phi','mass','charge')):
+    '''Stack object tables given as {flavor: DataFrame} (eg. {11: electrons, 13: muons})
+    into one table with a flavor column, sorted by event and then by decreasing pt.
+    object_idx is renumbered within each event of the merged table.'''
+    merged = pd.concat([df[list(columns)].assign(flavor=flavor) for flavor, df in collections.items()], ignore_index=True)
+    merged = merged.sort_values(['event','pt'], ascending=[True, False], kind='stable', ignore_index=True)
+    events, offsets = event_offsets(merged.event.to_numpy())
+    merged['object_idx'] = (np.arange(len(merged)) - np.repeat(offsets[:-1], np.diff(offsets))).astype(np.int32)
+    return merged
+
+def light_leptons(electrons, muons, min_pt=0):
+    return merge_collections({11: electrons[electrons.pt > min_pt], 13: muons[muons.pt > min_pt]})
+
+def clean_jet_ht(events, jets, leptons, min_jet_pt=30, max_delta_r=0.4):
+    '''Per event (in the order of events) scalar sum of the pt of jets above min_jet_pt
+    that are not within max_delta_r of any of the leptons.'''
+    jets = ensure_event_sorted(jets[jets.pt > min_jet_pt])
+    clean = ~any_within_delta_r(jets, ensure_event_sorted(leptons), max_delta_r)
+    ievent = np.searchsorted(events, jets.event.to_numpy()[clean])
+    return np.bincount(ievent, weights=jets.pt.to_numpy()[clean], minlength=len(events))
+
+def sfos_pair_plus_lepton(leptons, target_mass=91.2, min_leptons=3):
+    '''For events with at least min_leptons leptons (from merge_collections) and a same-flavor
+    opposite-charge pair, pick the pair with mass closest to target_mass and the
+    highest-pt lepton not in that pair. Returns the event numbers, the (i, j) pair
+    rows and the row of the extra lepton, all indexing the event-sorted leptons.'''
+    events, offsets = event_offsets(leptons.event.to_numpy())
+    ievent, first, second = pair_indices(offsets)
+    flavor, charge = leptons.flavor.to_numpy(), leptons.charge.to_numpy()
+    sfos = (np.diff(offsets)[ievent] >= min_leptons) & (flavor[first] == flavor[second]) & (charge[first] != charge[second])
+    ievent, first, second = ievent[sfos], first[sfos], second[sfos]
+
+    vectors = LVectorArray.from_df(leptons)
+    best_ievent, best = segment_argmin(np.abs((vectors[first] + vectors[second]).mass - target_mass), ievent)
+    first, second = first[best], second[best]
+
+    # leptons are pt ordered inside each event so the extra lepton is the first row not in the pair
+    extra = offsets[best_ievent]
+    for _ in range(2):
+        extra = np.where((extra == first) | (extra == second), extra+1, extra)
+
+    return events[best_ievent], first, second, extra
+
+def select_bench5(dfs):
+    events = dfs['event']
+    return {'fig5': events.MET_sumEt[events.event.isin(opposite_charge_pair_events(dfs['Muon'], 60, 120))]}
+
+def run_bench5(filename, output_dir='test_images'):
     '''Plot the MET of events that have an opposite-charge muon pair with an invariant mass between 60 GeV and 120 GeV.'''   
-    def opposite_muons(muons):
-        muon_combos = []
-        for im1, im2 in itertools.combinations(muons.index, 2):
-            m1, m2 = extract_rows(muons, im1, im2)
-            if m1.charge != m2.charge:
-                M = InvariantMass(m1,m2)
-                if M > 60 and M < 120:
-                    muon_combos.append((m1,m2))
-
-        return len(muon_combos) > 0
-
-    dfs = read_tgz(filename, collections=['event','Muon'])
-    muons = dfs['Events']['Muon']
-    opposite_muon_events = muons.groupby('event').filter(opposite_muons).event.unique()
-    events = dfs['Events']['event']
-    events = events[events.event.isin(opposite_muon_events)]
-
-    fig = px.histogram(events, 'MET_sumEt')
-    fig.write_image("test_images/fig5.pdf")
-
-def run_bench6(filename):
+    write_query_figures(5, run_query(5, filename, QUERY_CACHE), output_dir)
+
+def select_bench6(dfs):
+    trijets = best_trijets(dfs['Jet'], 172.5)
+    return {'fig6a': trijets.pt, 'fig6b': trijets.btagDeepB}
+
+def run_bench6(filename, output_dir='test_images'):
     '''For events with at least three jets, plot the pT of the trijet system four-momentum
        (i.e., any combination of three distinct jets within the same event) that has the invariant mass
        closest to 172.5 GeV in each event and plot the maximum b-tagging discriminant value among the jets in this trijet.'''
-    def get_best_combo(jets):
-        best_system = False
-        best_mass = 0
-        for ij1, ij2, ij3 in itertools.combinations(jets.index, 3):
-            j1, j2, j3 = extract_rows(jets, ij1, ij2, ij3)
-            if not best_system:
-                best_system = [j1, j2, j3]
-            else:
-                M = InvariantMass(j1,j2,j3)
-                if abs(best_mass - 172.5) > abs(M - 172.5):
-                    best_system = [j1, j2, j3]
-                    best_mass = M
+    write_query_figures(6, run_query(6, filename, QUERY_CACHE), output_dir)
 
-        return dd.DataFrame(best_system)
-    
-    dfs = read_folder(filename, collections=['event','Jet'])
-    print(dfs['Events']['Jet'].shape)
-    jets = dfs['Events']['Jet'].groupby('event').filter(lambda j: len(j) > 2)
-    print (jets.shape)
-    jets = jets.groupby('event', as_index=False).apply(get_best_combo)
-    
-    trijet_pt = jets.groupby('event').pt.sum()
-    figA = px.histogram(trijet_pt, 'pt')
-    figA.write_image('test_images/fig6a.pdf')
+def select_bench7(dfs):
+    events = np.sort(dfs['event'].event.to_numpy())
+    leptons = light_leptons(dfs['Electron'], dfs['Muon'], 10)
+    return {'fig7': clean_jet_ht(events, dfs['Jet'], leptons, 30, 0.4)}
 
-    max_btag = jets.groupby('event').btagDeepB.max()
-    figB = px.histogram(max_btag, 'btagDeepB')
-    figB.write_image('test_images/fig6b.pdf')
-
-
-def run_bench7(filename):
+def run_bench7(filename, output_dir='test_images'):
     '''Plot the scalar sum in each event of the pT of the jets with
        pT > 30 GeV that are not within 0.4 in \Delta R of any light
        lepton (i.e., electron or muon) with pT > 10 GeV.'''
-    pass
+    write_query_figures(7, run_query(7, filename, QUERY_CACHE), output_dir)
+
+def select_bench8(dfs):
+    events = ensure_event_sorted(dfs['event'])
+    leptons = light_leptons(dfs['Electron'], dfs['Muon'])
+    selected, first, second, extra = sfos_pair_plus_lepton(leptons, 91.2, 3)
 
-def run_bench8(filename):
+    met = events.iloc[np.searchsorted(events.event.to_numpy(), selected)]
+    met = LVectorArray.from_ptetaphim(met.MET_pt.to_numpy(), np.zeros(len(met)), met.MET_phi.to_numpy(), np.zeros(len(met)))
+    return {'fig8': LVectorArray.from_df(leptons)[extra].transverse_mass(met)}
+
+def run_bench8(filename, output_dir='test_images'):
     '''For events with at least three light leptons and a same-flavor
        opposite-charge light lepton pair, find such a pair that has the
        invariant mass closest to 91.2 GeV in each event and plot
        the transverse mass of the system, consisting of the missing
        transverse momentum and the highest-pT light lepton not
        in this pair'''
-    pass
+    write_query_figures(8, run_query(8, filename, QUERY_CACHE), output_dir)
+
+P4_COLUMNS = ['event','pt','eta','phi','mass']
+# columns to read per collection, optional read filters, the selection and the histograms
+# (name: (x label, Histogram arguments)) of every benchmark. Binning is fixed so that
+# histograms filled on separate chunks or partitions can be merged.
+ADL_QUERIES = {
+    1: {'columns': {'event': ['event','MET_sumEt']}, 'select': select_bench1,
+        'histograms': {'fig1': ('MET_sumEt', {'width': 20})}},
+    2: {'columns': {'Jet': ['event','pt']}, 'select': select_bench2,
+        'histograms': {'fig2': ('pt', {'width': 5})}},
+    3: {'columns': {'Jet': ['event','pt','eta']}, 'filters': {'Jet': [('eta','>',-1.0),('eta','<',1.0)]}, 'select': select_bench3,
+        'histograms': {'fig3': ('pt', {'width': 5})}},
+    4: {'columns': {'event': ['event','MET_sumEt'], 'Jet': ['event','pt']}, 'select': select_bench4,
+        'histograms': {'fig4': ('MET_sumEt', {'width': 20})}},
+    5: {'columns': {'event': ['event','MET_sumEt'], 'Muon': P4_COLUMNS+['charge']}, 'select': select_bench5,
+        'histograms': {'fig5': ('MET_sumEt', {'width': 20})}},
+    6: {'columns': {'Jet': P4_COLUMNS+['btagDeepB']}, 'select': select_bench6,
+        'histograms': {'fig6a': ('pt', {'width': 5}), 'fig6b': ('btagDeepB', {'bins': 50, 'range': (0, 1)})}},
+    7: {'columns': {'event': ['event'], 'Jet': P4_COLUMNS, 'Electron': P4_COLUMNS+['charge'], 'Muon': P4_COLUMNS+['charge']},
+        'select': select_bench7,
+        'histograms': {'fig7': ('ht', {'width': 10})}},
+    8: {'columns': {'event': ['event','MET_pt','MET_phi'], 'Electron': P4_COLUMNS+['charge'], 'Muon': P4_COLUMNS+['charge']},
+        'select': select_bench8, 'histograms': {'fig8': ('mt', {'width': 5})}},
+}
+
+def query_histograms(iquery):
+    return {name: Histogram(**kwargs) for name, (xlabel, kwargs) in ADL_QUERIES[iquery]['histograms'].items()}
 
+def fill_query(iquery, dfs, hists=None):
+    '''Run the selection of a benchmark on {collection: DataFrame} and fill its histograms.'''
+    hists = query_histograms(iquery) if hists is None else hists
+    for name, values in ADL_QUERIES[iquery]['select'](dfs).items():
+        hists[name].fill(values)
+    return hists
+
+class QueryCache():
+    '''Cache of decoded columns, keyed on the content of the source file (its checksum),
+    the tree, collection and column, the selection (filters) and, for streamed reads, the
+    row group, so that queries sharing
+    columns only decode them once and a changed source is never served stale data. Columns
+    are kept as Arrow arrays in an in-memory LRU of at most max_bytes; the least recently
+    used are spilled to uncompressed Feather files in spill_dir, which are memory-mapped
+    back on the next hit and survive the session.'''
+    def __init__(self, max_bytes=2*1024**3, spill_dir=None) -> None:
+        self.max_bytes = max_bytes
+        self.spill_dir = os.path.join(tempfile.gettempdir(), 'relational_nano_cache') if spill_dir is None else spill_dir
+        self.memory = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.spill_hits, self.misses = 0, 0, 0
+        self._checksums = {}
+
+    def source_checksum(self, filename):
+        '''Checksum of filename, only recomputed when its size or mtime change (see input_state).'''
+        state, _ = input_state(filename, self._checksums.get(os.path.abspath(filename)))
+        self._checksums[state['file']] = state
+        return state['checksum']
+
+    @staticmethod
+    def key(checksum, tree, collection, column, filters=None, row_group=None):
+        return hashlib.sha1(repr((checksum, tree, collection, column, normalize_filters(filters), row_group)).encode()).hexdigest()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f'{key}.feather')
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        if os.path.exists(self._spill_path(key)):
+            self.spill_hits += 1
+            array = feather.read_table(self._spill_path(key), memory_map=True).column(0)
+            self.put(key, array)
+            return array
+        return None
+
+    def put(self, key, array):
+        if key in self.memory:
+            self.nbytes -= self.memory.pop(key).nbytes
+        self.memory[key] = array
+        self.nbytes += array.nbytes
+        while self.nbytes > self.max_bytes and len(self.memory) > 1:
+            self._spill(*self.memory.popitem(last=False))
+
+    def _spill(self, key, array):
+        self.nbytes -= array.nbytes
+        path = self._spill_path(key)
+        if not os.path.exists(path):
+            os.makedirs(self.spill_dir, exist_ok=True)
+            feather.write_feather(pa.table({'values': array}), path+'.tmp', compression='uncompressed')
+            os.replace(path+'.tmp', path)
+
+    def clear(self, spilled=False):
+        self.memory.clear()
+        self.nbytes = 0
+        if spilled:
+            subprocess.call(['rm','-rf',self.spill_dir])
+
+    def read(self, filename, tree, collection, columns, filters, decode, row_group=None):
+        '''DataFrame of the columns of collection in filename (or of one of its row groups)
+        after filters. Only the columns that are not cached are decoded, with decode(columns) -> DataFrame.'''
+        checksum = self.source_checksum(filename)
+        keys = {c: self.key(checksum, tree, collection, c, filters, row_group) for c in columns}
+        arrays = {c: self.get(k) for c, k in keys.items()}
+        missing = [c for c, a in arrays.items() if a is None]
+        if missing:
+            self.misses += len(missing)
+            logging.debug(f'{tree}_{collection}: decoding {missing}')
+            table = pa.Table.from_pandas(decode(missing), preserve_index=False)
+            for c in missing:
+                arrays[c] = table.column(c)
+                self.put(keys[c], arrays[c])
+
+        return pa.table([arrays[c] for c in columns], names=list(columns)).to_pandas()
+
+QUERY_CACHE = QueryCache()
+
+def _cached_row_groups(cache, archive, tree, coll_name, columns, filters):
+    '''The row groups of a collection that may match filters, one DataFrame each, read through cache.'''
+    for irg in matching_row_groups(archive.parquet_file(tree, coll_name), filters):
+        yield cache.read(archive.filename, tree, coll_name, columns, filters,
+                         lambda read_columns: archive.read(tree, coll_name, read_columns, [irg], filters), irg)
+
+def _read_cached(cache, archive, tree, coll_name, columns, filters):
+    frames = list(_cached_row_groups(cache, archive, tree, coll_name, columns, filters))
+    if not frames:
+        return archive.read(tree, coll_name, columns, [], filters)
+    return pd.concat(frames, ignore_index=True)
+
+def run_query_archive(iquery, archive, tree='Events', cache=None):
+    '''Benchmark on a RelationalArchive. Queries over a single collection are streamed one
+    row group at a time, the others read their (projected) collections at once. With a
+    QueryCache the reads go through it one row group at a time, so that caching does not
+    load a streamed collection whole and both kinds of queries share the cached columns.'''
+    query = ADL_QUERIES[iquery]
+    columns, filters = query['columns'], query.get('filters')
+    if len(columns) == 1:
+        (coll_name, coll_columns), = columns.items()
+        coll_filters = _for_collection(filters, coll_name)
+        if cache is None:
+            frames = archive.iter_row_groups(tree, coll_name, coll_columns, coll_filters)
+        else:
+            frames = _cached_row_groups(cache, archive, tree, coll_name, coll_columns, coll_filters)
+
+        hists = query_histograms(iquery)
+        for df in frames:
+            fill_query(iquery, {coll_name: df}, hists)
+        return hists
+
+    if cache is not None:
+        return fill_query(iquery, {
+            coll_name: _read_cached(cache, archive, tree, coll_name, coll_columns, _for_collection(filters, coll_name))
+            for coll_name, coll_columns in columns.items()
+        })
+
+    return fill_query(iquery, {
+        coll_name: archive.read(tree, coll_name, coll_columns, filters=_for_collection(filters, coll_name))
+        for coll_name, coll_columns in columns.items()
+    })
+
+def event_ranges(event_files, events_per_partition=100000):
+    '''[low, high) event number ranges holding about events_per_partition events each.
+    Only the event column of the event tables is read.'''
+    events = np.sort(np.concatenate([pq.read_table(f, columns=['event']).column('event').to_numpy() for f in event_files]))
+    if len(events) == 0:
+        return []
+    bounds = np.unique(events[::events_per_partition])
+    return list(zip(bounds.tolist(), np.r_[bounds[1:], events[-1]+1].tolist()))
+
+def _read_event_range(event_range, files, columns=None, filters=None):
+    low, high = event_range
+    range_filters = [conjunction + [('event','>=',low), ('event','<',high)] for conjunction in normalize_filters(filters) or [[]]]
+    frames = []
+    for f in files:
+        pfile = pq.ParquetFile(f)
+        row_groups = matching_row_groups(pfile, range_filters)
+        if row_groups:
+            frames.append(pfile.read_row_groups(row_groups, columns=_with_filter_columns(columns, range_filters)).to_pandas())
+
+    df = pd.concat(frames, ignore_index=True) if frames else pq.read_schema(files[0]).empty_table().to_pandas()
+    df = sort_by_keys(apply_filters(df, range_filters))
+    return df if columns is None else df[list(columns)]
+
+DATASET_METADATA = '_dataset_{tree}.json'
+
+def _event_row_groups(metadata):
+    '''[min event, max event, rows] of every row group from the footer statistics, or None
+    if some row group has no statistics for the event column.'''
+    ievent = metadata.schema.names.index('event')
+    out = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        stats = row_group.column(ievent).statistics
+        if row_group.num_rows and (stats is None or not stats.has_min_max):
+            return None
+        if row_group.num_rows:
+            out.append([int(stats.min), int(stats.max), row_group.num_rows])
+    return out
+
+def _unique_events(path, metadata):
+    '''Whether the event numbers of the event table at path are unique, which event_key relies on.
+    A single run (from the run column statistics) is enough, otherwise the event column is read.'''
+    names = metadata.schema.names
+    if 'run' in names:
+        irun = names.index('run')
+        stats = [metadata.row_group(i).column(irun).statistics for i in range(metadata.num_row_groups) if metadata.row_group(i).num_rows]
+        if all(s is not None and s.has_min_max for s in stats) and len({s.min for s in stats} | {s.max for s in stats}) <= 1:
+            return True
+    events = np.sort(pq.read_table(path, columns=['event']).column('event').to_numpy())
+    return not (events[1:] == events[:-1]).any()
+
+def _promote_schemas(schemas):
+    '''One schema for the files of a collection. Numeric columns whose type differs between
+    files (eg. after value-range narrowing, see optimize_dtypes) get the NumPy promotion of
+    all of them; anything else keeps the type of the first file.'''
+    fields = []
+    for field in schemas[0]:
+        types = {schema.field(field.name).type for schema in schemas if field.name in schema.names}
+        if len(types) > 1 and all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+            field = field.with_type(pa.from_numpy_dtype(np.result_type(*[t.to_pandas_dtype() for t in types])))
+        fields.append(field)
+    return pa.schema(fields)
+
+def write_dataset_metadata(root, tree='Events'):
+    '''Write the sidecar of the dataset in directory root (DATASET_METADATA) from the Parquet
+    footers (event numbers are only read from files with several runs): for every converted file (<root>/<stem>/<tree>_<collection>.parquet, or the
+    files directly in root) the collection files and row counts, the event range and per row
+    group event statistics of its event table, and the offset of its first event in the
+    dataset. Also the (promoted) schema of every collection. Files whose event numbers repeat
+    (several runs with overlapping event numbers) are left out, see RelationalDataset.
+    Returns the metadata dict.'''
+    root = os.path.expanduser(root)
+    per_file = defaultdict(dict)
+    for path in sorted(glob.glob(os.path.join(root, f'{tree}_*.parquet')) + glob.glob(os.path.join(root, '*', f'{tree}_*.parquet'))):
+        per_file[os.path.relpath(os.path.dirname(path), root)][parse_member_name(path)[1]] = os.path.relpath(path, root)
+
+    files, schemas, offset = [], defaultdict(list), 0
+    for name, collections in per_file.items():
+        if 'event' not in collections:
+            logging.warning(f'{name} has no {tree} event table, leaving it out of the dataset')
+            continue
+        event_path = os.path.join(root, collections['event'])
+        if not _unique_events(event_path, pq.read_metadata(event_path)):
+            logging.error(f'{name} repeats event numbers (several runs?), leaving it out of the dataset')
+            continue
+        entry = {'name': name, 'collections': {}, 'event_offset': offset}
+        for coll_name, path in sorted(collections.items()):
+            metadata = pq.read_metadata(os.path.join(root, path))
+            entry['collections'][coll_name] = {'path': path, 'rows': metadata.num_rows}
+            schemas[coll_name].append(metadata.schema.to_arrow_schema())
+            if coll_name == 'event':
+                entry['row_groups'] = _event_row_groups(metadata)
+                entry['nevents'] = metadata.num_rows
+
+        offset += entry['nevents']
+        files.append(entry)
+
+    metadata = {
+        'tree': tree,
+        'nevents': offset,
+        'files': files,
+        'schemas': {coll_name: base64.b64encode(_promote_schemas(coll_schemas).serialize().to_pybytes()).decode()
+                    for coll_name, coll_schemas in schemas.items()},
+    }
+    with open(os.path.join(root, DATASET_METADATA.format(tree=tree)), 'w') as f:
+        json.dump(metadata, f)
+    return metadata
+
+def _event_partitions(row_groups, events_per_partition):
+    '''Group consecutive event row groups into [low, high) event ranges of about
+    events_per_partition events. Returns [(low, high, first row)]. A cut is only made where
+    every row group before it ends below every row group after it, so every event lands in
+    exactly one range even if the row groups overlap.'''
+    # lowest[i] is the smallest event of row groups i and later
+    lowest = list(itertools.accumulate(reversed([low for low, _, _ in row_groups]), min))[::-1]
+    out, start, first_row, row, reach = [], 0, 0, 0, None
+    for i, (_, high, nrows) in enumerate(row_groups):
+        row += nrows
+        reach = high if reach is None else max(reach, high)
+        last = i == len(row_groups) - 1
+        if last or (row - first_row >= events_per_partition and reach < lowest[i+1]):
+            out.append((lowest[start], reach + 1 if last else lowest[i+1], first_row))
+            start, first_row = i + 1, row
+    return out
+
+class RelationalDataset():
+    '''Dataset view over a directory of converted files (eg. the output of
+    make_relational_parquet_multi). Opening it only reads the sidecar written by
+    write_dataset_metadata (which is built on first open), so it does not touch any
+    Parquet file. Events are identified across the whole dataset by event_key, the event
+    offset of their file plus their position in its event-sorted event table, since event
+    numbers alone can repeat between files. Within a file they must not repeat (eg. one run
+    per file), as the object tables only carry the event number; write_dataset_metadata
+    leaves out the files where they do. Partitions are event ranges of one file cut at
+    row group boundaries of the event table, so partition i of every collection holds the
+    objects of the same events and nothing has to be shuffled to join them.'''
+    def __init__(self, root, tree='Events', events_per_partition=100000, refresh=False) -> None:
+        self.root = os.path.expanduser(root)
+        self.tree = tree
+        sidecar = os.path.join(self.root, DATASET_METADATA.format(tree=tree))
+        if refresh or not os.path.exists(sidecar):
+            self.metadata = write_dataset_metadata(self.root, tree)
+        else:
+            with open(sidecar) as f:
+                self.metadata = json.load(f)
+
+        self.files = self.metadata['files']
+        self.events_per_partition = events_per_partition
+        self._partitions = None
+
+    @property
+    def nevents(self):
+        return self.metadata['nevents']
+
+    @property
+    def collection_names(self):
+        return list(self.metadata['schemas'])
+
+    def schema(self, coll_name):
+        return pa.ipc.read_schema(pa.py_buffer(base64.b64decode(self.metadata['schemas'][coll_name])))
+
+    def rows(self, coll_name):
+        return sum(f['collections'][coll_name]['rows'] for f in self.files if coll_name in f['collections'])
+
+    @property
+    def partitions(self):
+        '''[(file index, low event, high event, event_key of the first event)]'''
+        if self._partitions is None:
+            self._partitions = []
+            for ifile, entry in enumerate(self.files):
+                row_groups = entry['row_groups']
+                if row_groups is None: # no statistics, fall back to reading the event numbers
+                    events = pq.read_table(os.path.join(self.root, entry['collections']['event']['path']), columns=['event']).column('event').to_numpy()
+                    row_groups = [[int(events.min()), int(events.max()), len(events)]] if len(events) else []
+                self._partitions.extend((ifile, low, high, entry['event_offset'] + first_row)
+                                        for low, high, first_row in _event_partitions(row_groups, self.events_per_partition))
+        return self._partitions
+
+    def _path(self, ifile, coll_name):
+        return os.path.join(self.root, self.files[ifile]['collections'][coll_name]['path'])
+
+    def _meta(self, coll_name, columns=None):
+        meta = self.schema(coll_name).empty_table().to_pandas()
+        meta = meta if columns is None else meta[list(columns)]
+        return meta.assign(event_key=pd.Series(dtype=np.int64))
+
+    def read_partition(self, partition, coll_name, columns=None, filters=None):
+        '''One partition of a collection as a DataFrame with an event_key column.'''
+        ifile, low, high, key_offset = partition
+        meta = self._meta(coll_name, columns)
+        if coll_name not in self.files[ifile]['collections']:
+            return meta
+
+        read_columns = None if columns is None else list(columns) + (['event'] if 'event' not in columns else [])
+        df = _read_event_range((low, high), [self._path(ifile, coll_name)], read_columns, filters)
+        # positions are taken in the unfiltered event table so that keys do not depend on the selection
+        events = _read_event_range((low, high), [self._path(ifile, 'event')], ['event'])['event'].to_numpy()
+        df['event_key'] = key_offset + np.searchsorted(events, df['event'].to_numpy())
+        for c, dtype in meta.dtypes.items():
+            if dtype.kind in 'iufb' and df[c].dtype != dtype:
+                df[c] = df[c].astype(dtype)
+        return df[list(meta.columns)]
+
+    def collection(self, coll_name, columns=None, filters=None):
+        '''Lazy dask DataFrame of a collection with one partition per entry of self.partitions.'''
+        return dd.dataframe.from_map(self.read_partition, self.partitions, coll_name=coll_name, columns=columns, filters=filters,
+                                     meta=self._meta(coll_name, columns))
+
+def read_dataset(root, tree='Events', collections=None, columns=None, filters=None, events_per_partition=100000):
+    '''read_folder for a RelationalDataset directory. Same output structure, and the
+    partitions of all collections are aligned.'''
+    dataset = RelationalDataset(root, tree, events_per_partition)
+    out = defaultdict(dict)
+    for coll_name in dataset.collection_names:
+        if (collections is None) or (coll_name in collections):
+            out[tree][coll_name] = dataset.collection(coll_name, _for_collection(columns, coll_name), _for_collection(filters, coll_name))
+    return out
+
+def read_folder_by_events(folder, tree='Events', collections=None, columns=None, filters=None, events_per_partition=100000):
+    '''Like read_folder, but every collection is split into the same event number ranges
+    (see event_ranges) so that partition i of every collection holds exactly the objects
+    of the events of partition i of the event table. Each partition is read with the
+    event range pushed down to the row group statistics.'''
+    subfilenames = defaultdict(list)
+    for subfilename in sorted(glob.glob(folder)):
+        tree_name, coll_name = parse_member_name(subfilename)
+        if tree_name == tree:
+            subfilenames[coll_name].append(subfilename)
+
+    ranges = event_ranges(subfilenames['event'], events_per_partition)
+    out = defaultdict(dict)
+    for coll_name, coll_files in subfilenames.items():
+        if (collections is None) or (coll_name in collections):
+            coll_columns, coll_filters = _for_collection(columns, coll_name), _for_collection(filters, coll_name)
+            meta = pq.read_schema(coll_files[0]).empty_table().to_pandas()
+            out[tree][coll_name] = dd.dataframe.from_map(_read_event_range, ranges, files=coll_files, columns=coll_columns, filters=coll_filters,
+                                                         meta=meta if coll_columns is None else meta[list(coll_columns)])
+
+    return out
+
+def _fill_aligned_partitions(iquery, dfs):
+    query = ADL_QUERIES[iquery]
+    coll_names = list(query['columns'])
+
+    def fill_partition(*frames):
+        return pd.Series([fill_query(iquery, dict(zip(coll_names, frames)))])
+
+    partition_hists = dd.dataframe.map_partitions(fill_partition, *[dfs[c] for c in coll_names],
+                                                  meta=pd.Series(dtype=object), align_dataframes=False).compute()
+    return {name: merge_histograms([h[name] for h in partition_hists]) for name in query['histograms']}
+
+def run_query_dask(iquery, folder, tree='Events', events_per_partition=100000):
+    '''Benchmark on dask. The collections are read partitioned by event range, the
+    selection and histogram filling run per partition with map_partitions (no shuffle,
+    since partitions of all collections are aligned) and the per-partition histograms
+    are merged on the client.'''
+    query = ADL_QUERIES[iquery]
+    coll_names = list(query['columns'])
+    dfs = read_folder_by_events(folder, tree, coll_names, query['columns'], query.get('filters'), events_per_partition)[tree]
+    return _fill_aligned_partitions(iquery, dfs)
+
+def run_query_dataset(iquery, root, tree='Events', events_per_partition=100000):
+    '''run_query_dask on a RelationalDataset directory.'''
+    query = ADL_QUERIES[iquery]
+    return _fill_aligned_partitions(iquery, read_dataset(root, tree, list(query['columns']), query['columns'], query.get('filters'), events_per_partition)[tree])
+
+def run_query(iquery, filename, cache=None):
+    '''Run benchmark iquery on a .tgz or .zip archive, or on dask for a dataset directory
+    or a folder glob of Parquet files. The archive reads go through cache (a QueryCache) if
+    given; the dask reads are lazy and per partition so they are not cached.'''
+    if filename.endswith('.tgz'):
+        with LazyTgz(filename) as archive:
+            return run_query_archive(iquery, archive, cache=cache)
+    elif filename.endswith('.zip'):
+        with LazyZip(filename) as archive:
+            return run_query_archive(iquery, archive, cache=cache)
+    elif os.path.isdir(os.path.expanduser(filename)):
+        return run_query_dataset(iquery, filename)
+    else:
+        return run_query_dask(iquery, filename)
+
+def write_query_figures(iquery, hists, output_dir='test_images'):
+    for name, hist in hists.items():
+        fig = histogram_figure(hist, ADL_QUERIES[iquery]['histograms'][name][0])
+        fig.write_image(f'{output_dir}/{name}.pdf')
+
+
+def make_synthetic_nano(filename, nevents=10000, seed=0):
+    '''Write a NanoAOD-like ROOT file so that the benchmarks can run without external data.
+    The Events tree has run/luminosityBlock/event, MET and trigger branches and Jet,
+    Muon and Electron collections stored as n{coll} counters plus {coll}_{var} jagged branches.'''
+    rng = np.random.default_rng(seed)
+    def collection(mean_count, mass, extra):
+        counts = rng.poisson(mean_count, nevents)
+        nobj = counts.sum()
+        columns = {
+            'pt': (rng.exponential(30, nobj) + 5).astype(np.float32),
+            'eta': rng.uniform(-2.5, 2.5, nobj).astype(np.float32),
+            'phi': rng.uniform(-np.pi, np.pi, nobj).astype(np.float32),
+            'mass': (rng.exponential(mass, nobj) if mass > 1 else np.full(nobj, mass)).astype(np.float32),
+        }
+        columns.update({name: make(nobj) for name, make in extra.items()})
+        return ak.zip({name: ak.unflatten(values, counts) for name, values in columns.items()})
+
+    charge = lambda n: rng.choice(np.array([-1, 1], dtype=np.int32), n)
+    branches = {
+        'run': np.ones(nevents, dtype=np.uint32),
+        'luminosityBlock': (np.arange(nevents)//1000 + 1).astype(np.uint32),
+        'event': np.arange(1, nevents+1, dtype=np.uint64),
+        'MET_pt': rng.exponential(40, nevents).astype(np.float32),
+        'MET_phi': rng.uniform(-np.pi, np.pi, nevents).astype(np.float32),
+        'MET_sumEt': rng.exponential(500, nevents).astype(np.float32),
+        'HLT_IsoMu24': rng.random(nevents) < 0.3,
+        'Jet': collection(5, 8, {'btagDeepB': lambda n: rng.random(n).astype(np.float32)}),
+        'Muon': collection(1.5, 0.106, {'charge': charge}),
+        'Electron': collection(1.2, 0.000511, {'charge': charge}),
+    }
+    with uproot.recreate(filename) as f:
+        f.mktree('Events', {name: b.type if isinstance(b, ak.Array) else b.dtype for name, b in branches.items()})
+        f['Events'].extend(branches)
+
+    return filename
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def _bytes_read():
+    '''Bytes read by this process through read() calls (rchar), if /proc is available.
+    Pages of memory-mapped files are not counted.'''
+    try:
+        with open('/proc/self/io') as f:
+            return int(dict(line.split(': ') for line in f.read().splitlines())['rchar'])
+    except (OSError, KeyError):
+        return None
+
+class StageMonitor():
+    '''Context manager recording the wall time, CPU time, peak RSS (sampled every
+    `interval` seconds) and bytes read of the code it wraps, in self.result.'''
+    def __init__(self, interval=0.005) -> None:
+        self.interval = interval
+        self.result = {}
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self._peak = max(self._peak, _current_rss())
+
+    def __enter__(self):
+        self._done = threading.Event()
+        self._peak = _current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        self._read, self._cpu, self._wall = _bytes_read(), time.process_time(), time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall, cpu, read = time.perf_counter(), time.process_time(), _bytes_read()
+        self._done.set()
+        self._thread.join()
+        self.result = {
+            'wall_s': wall - self._wall,
+            'cpu_s': cpu - self._cpu,
+            'peak_rss_bytes': max(self._peak, _current_rss()),
+            'bytes_read': None if read is None or self._read is None else read - self._read,
+        }
+        return False
+
+BACKENDS = ('tgz', 'zip', 'folder', 'sqlite')
+
+def prepare_backends(root_file, workdir, backends=BACKENDS):
+    '''Convert root_file to every storage backend. Returns {backend: path} and
+    the StageMonitor results of each conversion.'''
+    paths, conversion = {}, {}
+    folder = os.path.join(workdir, 'nano', '')
+    with StageMonitor() as monitor:
+        make_relational_parquet(root_file, folder, overwrite=True)
+    paths['folder'], conversion['folder'] = folder+'*.parquet', monitor.result
+
+    if 'tgz' in backends:
+        paths['tgz'] = os.path.join(workdir, 'nano.tgz')
+        with StageMonitor() as monitor, tarfile.open(paths['tgz'], 'w:gz') as tfile:
+            tfile.add(folder, arcname='nano')
+        conversion['tgz'] = monitor.result
+
+    if 'zip' in backends:
+        paths['zip'] = os.path.join(workdir, 'nano.zip')
+        with StageMonitor() as monitor:
+            pack_relational_zip(folder, paths['zip'])
+        conversion['zip'] = monitor.result
+
+    if 'sqlite' in backends:
+        paths['sqlite'] = os.path.join(workdir, 'nano.db')
+        with StageMonitor() as monitor:
+            make_relational_sql(root_file, paths['sqlite'], overwrite=os.path.exists(paths['sqlite']))
+        conversion['sqlite'] = monitor.result
+
+    return paths, conversion
+
+def load_query_collections(backend, path, iquery, tree='Events'):
+    '''{collection: DataFrame} with the columns (and filters) of benchmark iquery from one storage backend.'''
+    query = ADL_QUERIES[iquery]
+    columns, filters = query['columns'], query.get('filters')
+    if backend in ('tgz', 'zip'):
+        with LazyTgz(path) if backend == 'tgz' else LazyZip(path) as archive:
+            return {c: archive.read(tree, c, c_columns, filters=_for_collection(filters, c)) for c, c_columns in columns.items()}
+    elif backend == 'folder':
+        dfs = read_folder(path, tree, list(columns), columns, filters)[tree]
+        return dict(zip(columns, dd.compute(*[dfs[c] for c in columns])))
+    elif backend == 'sqlite':
+        return read_sql(path, tree, list(columns), columns, filters)[tree]
+    else:
+        raise ValueError(f'Unknown backend "{backend}". Must be one of {BACKENDS}.')
+
+def parquet_bytes_requested(pfile, columns=None, filters=None):
+    '''Bytes of the footer and of the column chunks of the matching row groups that a
+    read of columns with filters requests from pfile (pq.ParquetFile).'''
+    read_columns = _with_filter_columns(columns, filters)
+    total = pfile.metadata.serialized_size + 8
+    for irg in matching_row_groups(pfile, filters):
+        rg = pfile.metadata.row_group(irg)
+        total += sum(rg.column(i).total_compressed_size for i in range(rg.num_columns)
+                     if read_columns is None or rg.column(i).path_in_schema in read_columns)
+    return total
+
+def query_bytes_requested(backend, path, iquery, tree='Events'):
+    '''Parquet bytes requested by load_query_collections, independently of how the backend
+    gets them (read() calls, gzip stream or memory map). None for the sqlite backend.'''
+    query = ADL_QUERIES[iquery]
+    columns, filters = query['columns'], query.get('filters')
+    if backend in ('tgz', 'zip'):
+        with LazyTgz(path) if backend == 'tgz' else LazyZip(path) as archive:
+            return sum(parquet_bytes_requested(archive.parquet_file(tree, c), columns[c], _for_collection(filters, c)) for c in columns)
+    elif backend == 'folder':
+        pfiles = defaultdict(list)
+        for subfilename in sorted(glob.glob(path)):
+            tree_name, coll_name = parse_member_name(subfilename)
+            if tree_name == tree and coll_name in columns:
+                pfiles[coll_name].append(pq.ParquetFile(subfilename))
+    else:
+        return None
+    return sum(parquet_bytes_requested(pfile, columns[c], _for_collection(filters, c)) for c in columns for pfile in pfiles[c])
+
+def run_benchmark_harness(output_json='relational_nano_bench.json', nevents=20000, backends=BACKENDS,
+                          queries=tuple(ADL_QUERIES), workdir=None, seed=0, figures_dir=None):
+    '''Run the ADL benchmarks on a synthetic NanoAOD-like file stored in each backend and
+    write a JSON report with wall time, CPU time, peak RSS and bytes read for the load,
+    select and fill stage of every (backend, query), plus the conversion costs. bytes_read
+    is None for the zip backend (memory-mapped), and the load stage also records the
+    Parquet bytes_requested so that the Parquet backends can be compared. The histogram
+    entries are recorded too so that backends can be checked against each other.'''
+    workdir = tempfile.mkdtemp(prefix='relational_nano_') if workdir is None else workdir
+    os.makedirs(workdir, exist_ok=True)
+    root_file = os.path.join(workdir, 'synthetic_nano.root')
+    with StageMonitor() as generation:
+        make_synthetic_nano(root_file, nevents, seed)
+
+    paths, conversion = prepare_backends(root_file, workdir, backends)
+    results = []
+    for backend in backends:
+        for iquery in queries:
+            stages = {}
+            with StageMonitor() as monitor:
+                dfs = load_query_collections(backend, paths[backend], iquery)
+            stages['load'] = monitor.result
+            stages['load']['bytes_requested'] = query_bytes_requested(backend, paths[backend], iquery)
+            if backend == 'zip':
+                # the members are memory-mapped, their pages never go through read()
+                stages['load']['bytes_read'] = None
+
+            with StageMonitor() as monitor:
+                values = ADL_QUERIES[iquery]['select'](dfs)
+            stages['select'] = monitor.result
+
+            with StageMonitor() as monitor:
+                hists = query_histograms(iquery)
+                for name, v in values.items():
+                    hists[name].fill(v)
+            stages['fill'] = monitor.result
+
+            if figures_dir is not None:
+                os.makedirs(os.path.join(figures_dir, backend), exist_ok=True)
+                write_query_figures(iquery, hists, os.path.join(figures_dir, backend))
+
+            entries = {name: float(h.counts.sum() + h.underflow + h.overflow) for name, h in hists.items()}
+            logging.info(f'{backend} query {iquery}: ' + ', '.join(f'{s} {r["wall_s"]:.3f} s' for s, r in stages.items()))
+            results.append({'backend': backend, 'query': iquery, 'stages': stages, 'entries': entries})
+
+    for iquery in queries:
+        entries = [r['entries'] for r in results if r['query'] == iquery]
+        if any(e != entries[0] for e in entries):
+            logging.warning(f'Backends disagree on the histogram entries of query {iquery}: {entries}')
+
+    report = {
+        'config': {
+            'nevents': nevents, 'seed': seed, 'backends': list(backends), 'queries': list(queries), 'workdir': workdir,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'pyarrow': pa.__version__, 'uproot': uproot.__version__,
+        },
+        'generation': generation.result,
+        'conversion': conversion,
+        'results': results,
+    }
+    with open(output_json, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return report
 
 if __name__ == '__main__':
+    parser = ArgumentParser(description='Run the ADL benchmarks on a synthetic NanoAOD-like file in every storage backend.')
+
+    parser.add_argument('-o', '--output', metavar='OUTPUT', action='store', type=str,
+                    default   =   'relational_nano_bench.json',
+                    dest      =   'output',
+                    help      =   'Output JSON report')
+
+    parser.add_argument('-n', '--nevents', metavar='NEVENTS', action='store', type=int,
+                    default   =   20000,
+                    dest      =   'nevents',
+                    help      =   'Number of synthetic events')
+
+    parser.add_argument('-b', '--backends', metavar='BACKEND', type=str, nargs='+',
+                    default   =   list(BACKENDS),
+                    dest      =   'backends',
+                    help      =   'Storage backends to compare')
+
+    parser.add_argument('-q', '--queries', metavar='QUERY', type=int, nargs='+',
+                    default   =   list(ADL_QUERIES),
+                    dest      =   'queries',
+                    help      =   'Benchmarks to run')
+
+    parser.add_argument('-w', '--workdir', metavar='WORKDIR', action='store', type=str,
+                    default   =   None,
+                    dest      =   'workdir',
+                    help      =   'Directory for the synthetic file and its conversions (default is a new temporary directory)')
+
+    parser.add_argument('--seed', metavar='SEED', action='store', type=int,
+                    default   =   0,
+                    dest      =   'seed',
+                    help      =   'Random seed of the synthetic file')
+
+    parser.add_argument('--figures', metavar='FIGURES', action='store', type=str,
+                    default   =   None,
+                    dest      =   'figures',
+                    help      =   'Also write the figures of every backend to this directory')
+
+    args = parser.parse_args()
+
     start = time.time()
-    client = Client()
-    print(client.dashboard_link)
-    # run_bench1('nano_4.tgz')
-    # run_bench2('nano_4.tgz')
-    # run_bench3('nano_4.tgz')
-    # run_bench4('nano_4.tgz')
-    # run_bench5('nano_4.tgz')
-    # run_bench6('/home/lucas/CMS/temp/nano_4/*.parquet')
-    make_relational_parquet('/home/lucas/Projects/RDFanalyzer/TIMBER/examples/GluGluToHToTauTau_full.root','GluGluToHToTauTau_full',overwrite=True)
+    run_benchmark_harness(args.output, args.nevents, args.backends, args.queries, args.workdir, args.seed, args.figures)
     print (f'{(time.time()-start)/60} min')
-
@@ -0,0 +1,76 @@
+import numpy as np
+
+import delimitless_matcher as dm
+
+ITEMS = ['THselection_QCD_16.root', 'THselection_QCDHT1000_17.root', 'THselection_QCD_18.root']
+
+def test_tokenize():
+    ids, lengths, vocab = dm.tokenize(['THselection_QCD_16.root', 'a1b', ''])
+    assert ids.shape == (3, 4) and ids.dtype == np.int32
+    np.testing.assert_array_equal(lengths, [4, 3, 0])
+    assert vocab.decode(ids).tolist() == [['THselection', 'QCD', '16', 'root'], ['a', '1', 'b', ''], ['', '', '', '']]
+
+    assert vocab[dm.BLANK] == '' and vocab.ids[''] == dm.BLANK
+    assert vocab.intern('QCD') == ids[0, 1]
+    n = len(vocab)
+    assert vocab.intern('new') == n and vocab.intern('new') == n and vocab[n] == 'new'
+
+def test_merge_gains_brute_force():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        vocab = dm.Vocabulary(['a', 'b', 'c', 'd'])
+        ids = rng.integers(0, len(vocab), (rng.integers(1, 7), rng.integers(2, 8)))
+        ids[rng.random(ids.shape) < 0.3] = dm.BLANK # blanks in the middle of rows too
+
+        gains = dm.merge_gains(ids, vocab)
+        base = dm.total_entropy(ids)
+        expected = [[dm.total_entropy(dm.merge_next_cell(ids, vocab, irow, icol)) - base for icol in range(ids.shape[1]-1)]
+                    for irow in range(ids.shape[0])]
+        np.testing.assert_allclose(gains, np.array(expected).reshape(gains.shape), atol=1e-12)
+
+def _check_state(array):
+    '''The incrementally kept counts and tensions agree with recomputing them from the ids.'''
+    assert np.isclose(array.total_entropy(), dm.total_entropy(array.ids))
+    np.testing.assert_array_equal(array.counts.counts[:, :len(array.vocab)], dm.ColumnCounts(array.ids, len(array.vocab)).counts)
+    np.testing.assert_array_equal(array.tension, dm.token_tensions(array.ids))
+
+def test_token_array_inplace():
+    array = dm.TokenArray(ITEMS)
+    assert array.a.tolist()[1] == ['THselection', 'QCDHT', '1000', '17', 'root']
+    np.testing.assert_array_equal(array.lengths, [4, 5, 4])
+    token = array[0, 1]
+    assert (token.idx, token.val, token.frozen) == ((0, 1), 'QCD', False)
+
+    # not in place: the new ids are returned and the array is left alone
+    ids = array.ids.copy()
+    merged = array.merge_next_cell(token)
+    assert array.vocab.decode(merged)[0].tolist() == ['THselection', 'QCD-16', 'root', '', '']
+    np.testing.assert_array_equal(array.ids, ids)
+
+    assert array.merge_next_cell(token, in_place=True) is None
+    np.testing.assert_array_equal(array.ids, merged)
+    assert token.val == 'QCD-16' # tokens are views
+    np.testing.assert_array_equal(array.frozen, np.broadcast_to([True, False, False, False, False], array.shape))
+    _check_state(array)
+
+    array.slide_token_right(array[0, 2], in_place=True)
+    assert array.a.tolist()[0] == ['THselection', 'QCD-16', '', 'root', '']
+    _check_state(array)
+
+def test_token_array_frozen_sanity():
+    array = dm.TokenArray(ITEMS)
+    array.merge_next_cell(array[0, 1], in_place=True)
+    assert array[1, 0].frozen
+
+    # changes touching a frozen token are refused
+    ids = array.ids.copy()
+    array.merge_next_cell(array[1, 0], in_place=True)
+    array.drop_col(0, in_place=True)
+    np.testing.assert_array_equal(array.ids, ids)
+
+    # merge_next_col bypasses the check, and the frozen mask follows the new shape
+    array.merge_next_col(0, in_place=True)
+    assert array.shape == (3, 4)
+    assert array.a[:, 0].tolist() == ['THselection-QCD-16', 'THselection-QCDHT', 'THselection-QCD']
+    assert not array.frozen.any()
+    _check_state(array)
@@ -0,0 +1,107 @@
+import itertools, os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import uproot
+
+import relational_nano as rn
+
+def opposite_muons(muons):
+    '''Per-event scalar version of opposite_charge_pair_events, the reference the
+    columnar one is validated against.'''
+    muon_combos = []
+    for im1, im2 in itertools.combinations(muons.index, 2):
+        m1, m2 = rn.extract_rows(muons, im1, im2)
+        if m1.charge != m2.charge:
+            M = rn.InvariantMass(m1,m2)
+            if M > 60 and M < 120:
+                muon_combos.append((m1,m2))
+
+    return len(muon_combos) > 0
+
+def test_opposite_charge_pair_events(tmp_path):
+    filename = str(tmp_path/'nano.root')
+    rn.make_synthetic_nano(filename, nevents=500, seed=3)
+    muons = rn.extract_to_collections(uproot.open(filename), 'Events', True)['Muon']
+
+    expected = np.unique(muons.groupby('event').filter(opposite_muons).event.to_numpy())
+    assert len(expected) > 0
+    np.testing.assert_array_equal(rn.opposite_charge_pair_events(muons, 60, 120), expected)
+
+def test_event_partitions():
+    assert rn._event_partitions([[1, 10, 10], [11, 20, 10], [21, 30, 10]], 15) == [(1, 21, 0), (21, 31, 20)]
+    # the first row group reaches past the next ones, so nothing can be cut
+    assert rn._event_partitions([[1, 100, 10], [50, 60, 10], [70, 80, 10]], 5) == [(1, 101, 0)]
+    assert rn._event_partitions([[1, 30, 10], [20, 40, 10], [41, 50, 10], [51, 60, 10]], 5) == [(1, 41, 0), (41, 51, 20), (51, 61, 30)]
+
+def test_dataset_overlapping_row_groups(tmp_path):
+    events = np.array([1, 100, 2, 3, 4, 5, 6, 7, 8, 9] + list(range(50, 60)) + list(range(70, 80)), dtype=np.uint64)
+    os.makedirs(tmp_path/'f')
+    pq.write_table(pa.table({'event': events}), tmp_path/'f'/'Events_event.parquet', row_group_size=10)
+    pq.write_table(pa.table({'event': events, 'pt': events.astype(np.float32)}), tmp_path/'f'/'Events_Muon.parquet', row_group_size=10)
+
+    muons = rn.read_dataset(str(tmp_path), events_per_partition=5)['Events']['Muon'].compute()
+    assert sorted(muons.event) == sorted(events)
+    np.testing.assert_array_equal(muons.sort_values('event').event_key, np.arange(len(events)))
+
+def test_histogram_max_bins():
+    values = np.r_[np.arange(100.), 2e8]
+    hist = rn.Histogram(width=5).fill(values)
+    assert len(hist.counts) == 10000
+    assert (hist.counts.sum(), hist.underflow, hist.overflow) == (100, 0, 1)
+
+    # the window is kept around the bulk of the values, not the stray one
+    hist = rn.Histogram(width=5, max_bins=100).fill(-values)
+    assert (hist.counts.sum(), hist.underflow, hist.overflow) == (100, 1, 0)
+
+    merged = rn.Histogram(width=5, max_bins=100).fill(values[:50]) + rn.Histogram(width=5, max_bins=100).fill(values[50:] + 1e4)
+    assert len(merged.counts) == 100
+    assert merged.counts.sum() + merged.underflow + merged.overflow == len(values)
+
+def test_optimize_dtypes_stays_numeric():
+    df = pd.DataFrame({'bitmap': np.array([1000, 2000, 3000]*100, dtype=np.int64), 'pt': np.arange(300, dtype=np.float64)})
+    optimized, saved = rn.optimize_dtypes(df)
+    assert optimized.bitmap.dtype == np.uint16 and optimized.pt.dtype == np.float32 and saved > 0
+    assert (optimized.bitmap > 1500).sum() == 200
+    assert optimized.bitmap.sum() == df.bitmap.sum()
+
+def test_dataset_leaves_out_repeated_events(tmp_path):
+    def write(name, run, event):
+        os.makedirs(tmp_path/name)
+        table = pa.table({'run': np.array(run, dtype=np.uint32), 'event': np.array(event, dtype=np.uint64)})
+        pq.write_table(table, tmp_path/name/'Events_event.parquet', row_group_size=2)
+        pq.write_table(table.append_column('pt', pa.array(np.ones(len(event), dtype=np.float32))), tmp_path/name/'Events_Muon.parquet')
+
+    write('one_run', [1, 1, 1, 1], [1, 2, 3, 4])
+    write('two_runs', [1, 1, 2, 2], [1, 2, 5, 6])
+    write('repeated', [1, 1, 2, 2], [1, 2, 1, 2])
+
+    dataset = rn.RelationalDataset(str(tmp_path), events_per_partition=2)
+    assert [f['name'] for f in dataset.files] == ['one_run', 'two_runs']
+    keys = dataset.collection('Muon').compute().event_key
+    assert sorted(keys) == list(range(8))
+
+@pytest.mark.parametrize('row_group_size', [None, 200])
+def test_query_cache_decodes_columns_once(tmp_path, row_group_size):
+    filename = str(tmp_path/'nano.root')
+    rn.make_synthetic_nano(filename, nevents=500, seed=3)
+    archive = rn.make_relational_zip(filename, str(tmp_path/'nano.zip'), row_group_size=row_group_size)
+
+    # every distinct (collection, column, filters) of the suite, once per row group it may read
+    entries = {}
+    with rn.LazyZip(archive) as zfile:
+        for query in rn.ADL_QUERIES.values():
+            for coll_name, columns in query['columns'].items():
+                filters = rn._for_collection(query.get('filters'), coll_name)
+                nrg = len(rn.matching_row_groups(zfile.parquet_file('Events', coll_name), filters))
+                entries.update({(coll_name, column, repr(rn.normalize_filters(filters))): nrg for column in columns})
+    if row_group_size is None:
+        assert set(entries.values()) == {1}
+
+    cache = rn.QueryCache(spill_dir=str(tmp_path/'cache'))
+    for _ in range(2):
+        for iquery in rn.ADL_QUERIES:
+            rn.run_query(iquery, archive, cache)
+    assert cache.misses == sum(entries.values())